@@ -32,6 +32,12 @@ def all_zs_tensor(zs_min, zs_max):
     it = zip(zs_min, zs_max)
     return [range(int(a), int(b)+1) for a, b in it]
 
+# all z values in the z-min, z-max box as a (#zs, dim) int array; rows are in the
+# same order as itt.product(*all_zs_tensor(zs_min, zs_max))
+def all_zs_array(zs_min, zs_max):
+    ranges = [np.arange(int(a), int(b) + 1) for a, b in zip(zs_min, zs_max)]
+    return np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, len(ranges))
+
 # tensor product of z-min per dimension
 def z0_tensor(qx, zs_phi, zs_psi):
     return [(zs_phi if q2 == 0 else zs_psi)[0][d] for d, q2 in enumerate(qx)]
@@ -75,13 +81,27 @@ def calc_factor(l, dim, k):
     v_unit = (np.pi ** (dim/2.0)) / gamma(dim/2.0 + 1)
     return math.sqrt(v_unit) * (gamma(k) / gamma(k + 0.5)) / math.sqrt(l)
 
+# xs ** (dim / 2) using integer powers, plus one sqrt when dim is odd, in place of
+# the generic float power; for dim == 2 it is xs itself
+def half_dim_power(xs, dim):
+    half, odd = divmod(int(dim), 2)
+    if half == 0:
+        vals = np.ones_like(xs, dtype=float)
+    elif half == 1:
+        vals = np.array(xs, dtype=float)
+    else:
+        vals = np.power(xs, half, dtype=float)
+    if odd:
+        vals *= np.sqrt(xs)
+    return vals
+
 # calculate V(k);i for each row xs[i] and return dataset with that attached
 def calculate_nearest_balls(k, xs):
     dim = xs.shape[1]
     ball_tree = BallTree(xs)
     k_near_radious = ball_tree.query(xs, k + 1)[0][:,[-1]]
     factor = calc_factor(xs.shape[0], dim, k)
-    return np.power(k_near_radious, dim/2.0) * factor
+    return half_dim_power(k_near_radious, dim) * factor
 
 
 def gridify_xs(j0, j1, xs, minx, maxx):
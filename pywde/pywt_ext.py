@@ -6,7 +6,6 @@ import re
 import pywt
 import itertools as itt
 import numpy as np
-from scipy.interpolate import interp1d
 
 
 def wavelist():
@@ -17,8 +16,13 @@ def trim_zeros(coeffs):
     return coeffs[np.min(nz):np.max(nz) + 1]
 
 def calc_fun(support, values):
-    resp = interp1d(np.linspace(*support, num=len(values)), values, fill_value=0.0, bounds_error=False, kind=3)
+    # linear interpolation over the dense grid given by pywt; zero outside support
+    xp = np.linspace(*support, num=len(values))
+    fp = np.asarray(values, dtype=np.float64)
+    resp = lambda x: np.interp(x, xp, fp, left=0.0, right=0.0)
     resp.support = support
+    resp.xp = xp
+    resp.fp = fp
     return resp
 
 _RE1 = re.compile('(db|sym)([0-9]+)')
@@ -143,7 +147,8 @@ class Wavelet(pywt.Wavelet):
         # a - z <= s x <= b - z
         # (a - z)/s <= x <= (b - z)/s
         s2 = math.sqrt(s)
-        f = lambda x: s2 * fun(s * x + z)
+        xp, fp = fun.xp, fun.fp
+        f = lambda x: s2 * np.interp(s * x + z, xp, fp, left=0.0, right=0.0)
         f.support = ((a - z)/s, (b - z)/s)
         f._ix = ix
         return f
@@ -199,6 +204,7 @@ class WaveletTensorProduct(object):
         self.orthogonal = all([wave.orthogonal for wave in self.waves])
         self.qq = list(itt.product(range(2), repeat=self.dim))
         self.name = 'x'.join(wave_names)
+        self.prod_subscripts = self.calc_prod_subscripts(self.dim)
 
     def to_dict(self):
         return dict(
@@ -214,8 +220,15 @@ class WaveletTensorProduct(object):
         resp.orthogonal = all([wave.orthogonal for wave in resp.waves])
         resp.qq = list(itt.product(range(2), repeat=resp.dim))
         resp.name = a_dict['name']
+        resp.prod_subscripts = WaveletTensorProduct.calc_prod_subscripts(resp.dim)
         return resp
 
+    @staticmethod
+    def calc_prod_subscripts(dim):
+        # element-wise product of dim arrays of any (same) shape in a single pass, so
+        # no intermediate arrays; no contraction path is needed for a pure element-wise product
+        return ','.join(['...'] * dim) + '->...'
+
     def __repr__(self):
         spec = ','.join([wave.name for wave in self.waves])
         return '<WaveletTensorProduct (%s)>' % spec
@@ -237,21 +250,42 @@ class WaveletTensorProduct(object):
         qq, ss, zz = ix
         supp_min = np.array([self.waves[i].support[what][qq[i]][0] for i in range(self.dim)])
         supp_max = np.array([self.waves[i].support[what][qq[i]][1] for i in range(self.dim)])
+        # gather the interpolation grids once; see Wavelet.fun_ix for the 1D case
+        grids = [(self.waves[i].funs[what][qq[i]].xp, self.waves[i].funs[what][qq[i]].fp) for i in range(self.dim)]
+        ss2 = math.sqrt(np.prod(ss))
         def f(xx):
             proj = self.proj_fun(self.dim, xx)
-            resp = None
-            for i in range(self.dim):
-                col_i = self.waves[i].fun_ix(what, (qq[i], ss[i], zz[i]))(proj(i))
-                if resp is None:
-                    resp = col_i
-                else:
-                    resp = np.multiply(resp, col_i)
-            return resp
+            cols = [np.interp(ss[i] * proj(i) + zz[i], xp, fp, left=0.0, right=0.0)
+                    for i, (xp, fp) in enumerate(grids)]
+            return np.einsum(self.prod_subscripts, *cols) * ss2
         f.dim = self.dim
         f.support = np.array([supp_min - zz, supp_max - zz]) / ss
         f._ix = ix
         return f
 
+    def fun_supp_ix(self, what, ix):
+        """
+        Same as `fun_ix` and `supp_ix` in a single pass over xx, as both need the
+        scaled coordinates ss * x + zz
+        :return: function object (callable) returning (values, support indicator) at xx
+        """
+        qq, ss, zz = ix
+        funs = [self.waves[i].funs[what][qq[i]] for i in range(self.dim)]
+        ss2 = math.sqrt(np.prod(ss))
+        def f(xx):
+            proj = self.proj_fun(self.dim, xx)
+            cols = []
+            resp = None
+            for i, fun in enumerate(funs):
+                v = ss[i] * proj(i) + zz[i]
+                a, b = fun.support
+                cols.append(np.interp(v, fun.xp, fun.fp, left=0.0, right=0.0))
+                col_i = np.less(a, v) & np.less(v, b)
+                resp = col_i if resp is None else resp & col_i
+            return np.einsum(self.prod_subscripts, *cols) * ss2, resp.astype(int)
+        f._ix = ix
+        return f
+
     def supp_ix(self, what, ix):
         qq, ss, zz = ix
         def f(xx):
@@ -3,12 +3,15 @@ import itertools as itt
 import numpy as np
 from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
+from joblib import Parallel, delayed
 from scipy.special import gamma
-from sklearn.neighbors import BallTree
+from scipy.sparse import csr_matrix
+from sklearn.neighbors import KDTree
 import random
 
 from pywde.pywt_ext import WaveletTensorProduct
-from pywde.common import all_zs_tensor
+from pywde.common import all_zs_array, half_dim_power
 
 
 class dictwithfactory(dict):
@@ -24,14 +27,85 @@ class dictwithfactory(dict):
         return val
 
 
+class ZsValues(object):
+    """Values at xs of wave functions indexed by zs, stored as a (#zs, n) matrix with
+    one row per zs. It can be used as a read-only dict from zs to values."""
+    def __init__(self, zs_array, values):
+        self.zs_array = zs_array
+        self.zs_list = list(map(tuple, zs_array.tolist()))
+        self.values = values
+        self.index = {zs: row for row, zs in enumerate(self.zs_list)}
+        # rows of zs also in the paired base/dual system, see `SPWDE.calc_funs_at`
+        self.common_rows = None
+
+    def __contains__(self, zs):
+        return zs in self.index
+
+    def __getitem__(self, zs):
+        return self.values[self.index[zs]]
+
+    def __iter__(self):
+        return iter(self.zs_list)
+
+    def __len__(self):
+        return len(self.zs_list)
+
+    def rows(self, zs_list):
+        "Row positions in `values` for given zs"
+        return np.array([self.index[zs] for zs in zs_list], dtype=int)
+
+    def intersect(self, other):
+        "Row positions (in self, in other) of zs in both, in lexicographic zs order"
+        if len(self) == 0 or len(other) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        # linearise zs over the box covering both so rows match as integers
+        lo = np.minimum(self.zs_array.min(axis=0), other.zs_array.min(axis=0))
+        shape = np.maximum(self.zs_array.max(axis=0), other.zs_array.max(axis=0)) - lo + 1
+        keys = np.ravel_multi_index((self.zs_array - lo).T, shape)
+        other_keys = np.ravel_multi_index((other.zs_array - lo).T, shape)
+        # intersect1d(return_indices=True) needs numpy >= 1.15, so match rows by hand
+        rows = np.nonzero(np.isin(keys, other_keys, assume_unique=True))[0]
+        rows = rows[np.argsort(keys[rows], kind='mergesort')]
+        other_order = np.argsort(other_keys, kind='mergesort')
+        other_rows = other_order[np.searchsorted(other_keys, keys[rows], sorter=other_order)]
+        return rows, other_rows
+
+
 class SPWDE(object):
-    def __init__(self, waves, k=1):
+    def __init__(self, waves, k=1, dtype=np.float64):
+        """
+        :param waves: ((wave name, j0), ...) per dimension
+        :param k: k-th nearest neighbour for the ball volumes
+        :param dtype: dtype to store wave values at xs and balls matrices; np.float32 halves
+            their memory while sums are still returned in float64
+        """
         self.wave = WaveletTensorProduct([wave_desc[0] for wave_desc in waves])
         self.j0s = [wave_desc[1] for wave_desc in waves]
         self.k = k
+        self.dtype = dtype
+        self._level_meta_cache = {}
         self.minx = None
         self.maxx = None
 
+    # the level meta depends on the range of the data, so updating it drops the cache
+    @property
+    def minx(self):
+        return self._minx
+
+    @minx.setter
+    def minx(self, value):
+        self._minx = value
+        self._level_meta_cache = {}
+
+    @property
+    def maxx(self):
+        return self._maxx
+
+    @maxx.setter
+    def maxx(self, value):
+        self._maxx = value
+        self._level_meta_cache = {}
+
     # target distance
     TARGET_NORMED = 'normed'
     TARGET_DIFF = 'diff'
@@ -41,7 +115,16 @@ class SPWDE(object):
     TH_ADJUSTED = 'adjusted' # Delyon & Judistky
     TH_EMP_STD = 'emp-var' # New
 
-    def best_j(self, xs, mode, stop_on_max=False):
+    def best_j(self, xs, mode, stop_on_max=False, n_jobs=None, early_stop=True):
+        """
+        Calculates B hat for each level j and the corresponding pdf. In normed mode, levels
+        are run in turn and it stops after the first decrease of B hat, unless `early_stop`
+        is False (e.g. for validation runs). Otherwise levels are independent of each other,
+        so they are run concurrently on `n_jobs` threads (see joblib.Parallel; None runs
+        them in turn) unless `stop_on_max` is set. The elapsed time recorded in `best_j_data`
+        is the seconds from the start until the level was done; levels run concurrently
+        all get the time of the whole run.
+        """
         t0 = datetime.now()
         assert mode in [self.TARGET_NORMED, self.TARGET_DIFF], 'Wrong mode'
 
@@ -50,63 +133,44 @@ class SPWDE(object):
         self.minx = np.amin(xs, axis=0)
         self.maxx = np.amax(xs, axis=0)
         omega = calc_omega(xs.shape[0], self.k)
-        best_b_hat_j = None
-        best_j = None
-        for j in range(8):
+        js = range(8)
+        if stop_on_max:
             # In practice, one would stop when maximum is reached, i.e. after first decreasing value of B Hat
-            g_ring_no_i_xs = []
-            wave_base_j_00_ZS, wave_base_j_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs = self.calc_funs_at(j, (0, 0), xs)
-            if mode == self.TARGET_DIFF:
-                coeff_j_00_ZS = self.calc_coeffs(wave_base_j_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs, j, xs, balls_info, (0, 0))
-                coeffs = np.array(list(coeff_j_00_ZS.values()))
-                alphas_norm_2 = (coeffs[:,0] * coeffs[:,1]).sum()
-            for i, x in enumerate(xs):
-                coeff_no_i_j_00_ZS = self.calc_coeffs_no_i(wave_base_j_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs, j, xs, i, balls_info, (0, 0))
-                g_ring_no_i_at_xi = 0.0
-                norm2 = 0.0
-                for zs in coeff_no_i_j_00_ZS:
-                    if zs not in wave_base_j_00_ZS_at_xs:
-                        continue
-                    alpha_zs, alpha_d_zs = coeff_no_i_j_00_ZS[zs]
-                    g_ring_no_i_at_xi += alpha_zs * wave_base_j_00_ZS_at_xs[zs][i]
-                    norm2 += alpha_zs * alpha_d_zs
-                # q_ring_x ^ 2 / norm2 == f_at_x
-                if norm2 == 0.0:
-                    if g_ring_no_i_at_xi == 0.0:
-                        g_ring_no_i_xs.append(0.0)
-                    else:
-                        raise RuntimeError('Got norms but no value')
+            best_b_hat_j = None
+            best_j = None
+            for j in js:
+                b_hat_j, _ = self._process_level(j, xs, mode, balls_info, omega, with_pdf=False)
+                if best_j is None:
+                    best_j = j
+                    best_b_hat_j = b_hat_j
+                elif b_hat_j > best_b_hat_j:
+                    best_j = j
+                    best_b_hat_j = b_hat_j
                 else:
-                    if mode == self.TARGET_NORMED:
-                        g_ring_no_i_xs.append(g_ring_no_i_at_xi * g_ring_no_i_at_xi / norm2)
-                    else: # mode == self.MODE_DIFF:
-                        g_ring_no_i_xs.append(g_ring_no_i_at_xi * g_ring_no_i_at_xi)
-            g_ring_no_i_xs = np.array(g_ring_no_i_xs)
-            if mode == self.TARGET_NORMED:
-                b_hat_j = omega * (np.sqrt(g_ring_no_i_xs) * balls_info.sqrt_vol_k).sum()
-            else: # mode == self.MODE_DIFF:
-                b_hat_j = 2 * omega * (np.sqrt(g_ring_no_i_xs) * balls_info.sqrt_vol_k).sum() - alphas_norm_2
-            print(mode, j, b_hat_j)
-            if best_j is None:
-                best_j = j
-                best_b_hat_j = b_hat_j
-            elif b_hat_j > best_b_hat_j:
-                best_j = j
-                best_b_hat_j = b_hat_j
-            elif stop_on_max:
-                self.the_best_j = best_j
-                return best_j
-            if stop_on_max:
-                continue
-            # if calculating pdf
-            name = 'WDE Alphas, dj=%d' % j
-            if mode == self.TARGET_DIFF:
-                pdf = self.calc_pdf(wave_base_j_00_ZS, coeff_j_00_ZS, name)
-            else:
-                coeff_j_00_ZS = self.calc_coeffs(wave_base_j_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs, j, xs, balls_info, (0, 0))
-                pdf = self.calc_pdf(wave_base_j_00_ZS, coeff_j_00_ZS, name)
+                    self.the_best_j = best_j
+                    return best_j
+        elif n_jobs is None or (early_stop and mode == self.TARGET_NORMED):
+            # levels in turn; in normed mode with early stop, the level where B hat first
+            # decreases is recorded, but no further ones
+            stop_on_decrease = early_stop and mode == self.TARGET_NORMED
+            prev_b_hat_j = -math.inf
+            for j in js:
+                b_hat_j, pdf = self._process_level(j, xs, mode, balls_info, omega)
+                elapsed = (datetime.now() - t0).total_seconds()
+                best_j_data.append((j, b_hat_j, pdf, elapsed))
+                if stop_on_decrease and b_hat_j < prev_b_hat_j:
+                    break
+                prev_b_hat_j = b_hat_j
+        else:
+            # numpy releases the GIL on the heavy lifting, so threads are enough and
+            # the pdfs (closures) need not be pickled
+            levels = Parallel(n_jobs=n_jobs, prefer='threads')(
+                delayed(self._process_level)(j, xs, mode, balls_info, omega) for j in js
+            )
+            # levels run at the same time, so all are available after the whole call
             elapsed = (datetime.now() - t0).total_seconds()
-            best_j_data.append((j, b_hat_j, pdf, elapsed))
+            for j, (b_hat_j, pdf) in zip(js, levels):
+                best_j_data.append((j, b_hat_j, pdf, elapsed))
 
         best_b_hat = max([info_j[1] for info_j in best_j_data])
         best_j = list(filter(lambda info_j: info_j[1] == best_b_hat, best_j_data))[0][0]
@@ -114,6 +178,38 @@ class SPWDE(object):
             tuple([info_j[0], info_j[0] == best_j, info_j[1], info_j[2], info_j[3]])
             for info_j in best_j_data]
 
+    def _process_level(self, j, xs, mode, balls_info, omega, with_pdf=True):
+        "Returns (B hat, pdf) for level j in `best_j`; pdf is None when not `with_pdf`"
+        n = xs.shape[0]
+        wave_base_j_00_ZS, wave_base_j_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs = self.calc_funs_at(j, (0, 0), xs)
+        # one pass for the coefficients, used by the diff target and the pdf
+        if mode == self.TARGET_DIFF or with_pdf:
+            coeff_j_00_ZS = self.calc_coeffs(wave_base_j_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs, xs, balls_info)
+        if mode == self.TARGET_DIFF:
+            alphas_norm_2 = np.dot(coeff_j_00_ZS.alphas, coeff_j_00_ZS.alphas_d)
+        g_ring_no_i_at_xs, norm2_xs = self.calc_g_ring_no_i(wave_base_j_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs,
+                                                            xs, balls_info)
+        # q_ring_x ^ 2 / norm2 == f_at_x
+        no_norm = norm2_xs == 0.0
+        if (g_ring_no_i_at_xs[no_norm] != 0.0).any():
+            raise RuntimeError('Got norms but no value')
+        # sqrt(g_ring ^ 2) == |g_ring|
+        g_ring_no_i_xs = np.zeros(n)
+        if mode == self.TARGET_NORMED:
+            g_ring_no_i_xs[~no_norm] = np.abs(g_ring_no_i_at_xs[~no_norm]) / np.sqrt(norm2_xs[~no_norm])
+        else: # mode == self.MODE_DIFF:
+            g_ring_no_i_xs[~no_norm] = np.abs(g_ring_no_i_at_xs[~no_norm])
+        if mode == self.TARGET_NORMED:
+            b_hat_j = omega * (g_ring_no_i_xs * balls_info.sqrt_vol_k).sum()
+        else: # mode == self.MODE_DIFF:
+            b_hat_j = 2 * omega * (g_ring_no_i_xs * balls_info.sqrt_vol_k).sum() - alphas_norm_2
+        print(mode, j, b_hat_j)
+        if not with_pdf:
+            return b_hat_j, None
+        # if calculating pdf
+        name = 'WDE Alphas, dj=%d' % j
+        pdf = self.calc_pdf(wave_base_j_00_ZS, coeff_j_00_ZS, name)
+        return b_hat_j, pdf
 
     def best_c(self, xs, delta_j, opt_target, th_mode):
         """best c - hard thresholding"""
@@ -134,11 +230,9 @@ class SPWDE(object):
         # dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at [ (j, qq) ] => a triple with
         #   wave_base_0_00_ZS, wave_base_0_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs
 
-        # memoise balls
-        all_balls = []
-        for i in range(len(xs)):
-            balls = balls_no_i(balls_info, i)
-            all_balls.append(balls)
+        # memoise ball corrections for leave-one-out sums
+        deltas = balls_no_i_deltas(balls_info)
+        omega_no_i = calc_omega(xs.shape[0] - 1, self.k)
 
         # rank betas from large to smallest; we will incrementaly calculate
         # the HD_i for each in turn
@@ -147,71 +241,60 @@ class SPWDE(object):
         for (j, qq), triple in dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at.items():
             _, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs = triple
             if qq == (0, 0):
-                alphas_dict = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, 0, xs, balls_info, (0, 0))
+                alphas_table = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info)
                 continue
-            cc = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, j, xs, balls_info, qq)
-            for zs in cc:
-                coeff_zs, coeff_d_zs = cc[zs]
+            cc = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info)
+            if beta_var:
+                # std of leave-one-out coefficients, for all zs in the level at once
+                coeffs_no_i = omega_no_i * sums_no_i(wave_dual_j_qq_ZS_at_xs.values, balls_info, deltas)
+                coeffs_i_std = coeffs_no_i.std(axis=1)
+            else:
+                coeffs_i_std = np.zeros(len(cc.zs_list))
+            for zs, coeff_zs, coeff_d_zs, coeff_i_std in zip(cc.zs_list, cc.alphas, cc.alphas_d, coeffs_i_std):
                 if coeff_zs == 0.0:
                     continue
-                if beta_var:
-                    coeff_i_vals = []
-                    for i, x in enumerate(xs):
-                        coeff_i, coeff_d_i = self.calc_1_coeff_no_i(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, j,
-                                                                    xs, i, all_balls[i], qq, zs)
-                        coeff_i_vals.append(coeff_i)
-                    # coeff_i_std = np.array(coeff_i_vals).std()
-                    coeff_i_std = (np.array(coeff_i_vals) - coeff_zs).std()
-                else:
-                    coeff_i_std = 0.
                 all_betas.append((j, qq, zs, coeff_zs, coeff_d_zs, coeff_i_std))
 
-        # order2 : 1995, Donoho, Johnstone, Kerkyacharian, Picard - Wavelet Shrinkage, Asymptopia
-        order1 = lambda tt: math.fabs(tt[3])
-        # order1 : 1996, Delyon, Juditsky - On Minimax Wavelet Estimators
-        order2 = lambda tt: math.fabs(tt[3]) / math.sqrt(delta_j - tt[0])
+        abs_coeffs = np.abs(np.array([tt[3] for tt in all_betas], dtype=float))
+        js = np.array([tt[0] for tt in all_betas], dtype=float)
+        coeffs_std = np.array([tt[5] for tt in all_betas], dtype=float)
+        # order1 : 1995, Donoho, Johnstone, Kerkyacharian, Picard - Wavelet Shrinkage, Asymptopia
+        # order2 : 1996, Delyon, Juditsky - On Minimax Wavelet Estimators
         # order3 : New things
-        # order3 = lambda tt: math.fabs(tt[3]) - 4 * tt[5] ## kind of work for low n
-        # order3 = lambda tt: math.fabs(tt[3]) / (math.fabs(tt[3]) * 0.5 + tt[5]) # ??
-        # order3 = lambda tt: tt[5]
-        # order3 = lambda tt: math.fabs(tt[3]) / tt[5] / math.sqrt(delta_j - tt[0])
-        order4 = lambda tt: math.fabs(tt[3]) / tt[5]
+        # keys = abs_coeffs - 4 * coeffs_std ## kind of work for low n
+        # keys = abs_coeffs / (abs_coeffs * 0.5 + coeffs_std) # ??
+        # keys = coeffs_std
+        # keys = abs_coeffs / coeffs_std / np.sqrt(delta_j - js)
         if th_mode == self.TH_CLASSIC:
-            key_order = order1
+            keys = abs_coeffs
             subtitle = r"$\left| \beta_{j,q,z} \right| \geq C$"
         elif th_mode == self.TH_ADJUSTED:
-            key_order = order2
+            keys = abs_coeffs / np.sqrt(delta_j - js)
             subtitle = r"$\left| \beta_{j,q,z} \right| \geq C \sqrt{j + 1}$"
         elif th_mode == self.TH_EMP_STD:
-            key_order = order4
+            # betas are non-zero, so a zero leave-one-out std makes |beta| / std unbounded;
+            # those get +inf and rank first (in their original order, see below)
+            keys = np.full(abs_coeffs.shape, np.inf)
+            has_std = coeffs_std > 0.0
+            keys[has_std] = abs_coeffs[has_std] / coeffs_std[has_std]
             subtitle = r"$\left| \beta_{j,q,z} \right| \geq C \hat{\sigma}\left[\beta_{j,q,z}^{(-i)}\right]$"
         else:
             raise RuntimeError('Unknown threshold mode')
-        all_betas = sorted(all_betas, key=key_order, reverse=True)
+        # stable sort on the negated keys keeps ties in their original order,
+        # as sorted(..., reverse=True) does
+        order = np.argsort(-keys, kind='mergesort')
+        all_betas = [all_betas[pos] for pos in order]
+        keys = keys[order]
 
         # get base line for acummulated values by computing alphas and the
         # target HD_i functions
         _, wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs = dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at[(0, (0, 0))]
-        g_ring_no_i_xs = np.zeros(xs.shape[0])
-        norm2_xs = np.zeros(xs.shape[0])
-        for i, x in enumerate(xs):
-            coeff_no_i_0_00_ZS = self.calc_coeffs_no_i(wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs, 0, xs, i,
-                                                       balls_info, (0, 0))
-            for zs in coeff_no_i_0_00_ZS:
-                if zs not in wave_base_0_00_ZS_at_xs:
-                    continue
-                alpha_zs, alpha_d_zs = coeff_no_i_0_00_ZS[zs]
-                g_ring_no_i_xs[i] += alpha_zs * wave_base_0_00_ZS_at_xs[zs][i]
-                norm2_xs[i] += alpha_zs * alpha_d_zs
+        g_ring_no_i_xs, norm2_xs = self.calc_g_ring_no_i(wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs,
+                                                          xs, balls_info)
 
         ## print('g_ring_no_i_xs', g_ring_no_i_xs * g_ring_no_i_xs) << !!! OK !!!
 
-        num_alphas = 0
-        for zs in alphas_dict:
-            alpha_zs, alpha_d_zs = alphas_dict[zs]
-            if alpha_zs == 0.0 or alpha_d_zs == 0.0:
-                continue
-            num_alphas += 1
+        num_alphas = np.count_nonzero((alphas_table.alphas != 0.0) & (alphas_table.alphas_d != 0.0))
 
         omega_nk = calc_omega(xs.shape[0], self.k)
         best_c_data = []
@@ -220,21 +303,21 @@ class SPWDE(object):
         for cx, beta_info in enumerate(all_betas):
             j, qq, zs, coeff , coeff_d, coeff_i_std = beta_info
             _, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs = dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at[(j, qq)]
-            coeff_i_vals = []
-            for i, x in enumerate(xs):
-                coeff_i, coeff_d_i = self.calc_1_coeff_no_i(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, j, xs, i, all_balls[i], qq, zs)
-                if zs not in wave_base_j_qq_ZS_at_xs:
-                    continue
-                g_ring_no_i_xs[i] += coeff_i * wave_base_j_qq_ZS_at_xs[zs][i]
-                norm2_xs[i] += coeff_i * coeff_d_i
-                coeff_i_vals.append(coeff_i)
+            if zs in wave_base_j_qq_ZS_at_xs:
+                coeff_i_vals, coeff_d_i_vals = self.calc_1_coeff_no_i_all(wave_base_j_qq_ZS_at_xs,
+                                                                         wave_dual_j_qq_ZS_at_xs,
+                                                                         xs, balls_info, zs, deltas)
+                g_ring_no_i_xs += coeff_i_vals * wave_base_j_qq_ZS_at_xs[zs]
+                norm2_xs += coeff_i_vals * coeff_d_i_vals
+            else:
+                coeff_i_vals = np.empty(0)
 
             if opt_target == self.TARGET_NORMED:
-                b_hat_beta = omega_nk * (np.sqrt(g_ring_no_i_xs * g_ring_no_i_xs /  norm2_xs) * balls_info.sqrt_vol_k).sum()
+                b_hat_beta = omega_nk * (np.abs(g_ring_no_i_xs) / np.sqrt(norm2_xs) * balls_info.sqrt_vol_k).sum()
             else:  # mode == self.MODE_DIFF:
-                b_hat_beta = 2 * omega_nk * (np.sqrt(g_ring_no_i_xs * g_ring_no_i_xs) * balls_info.sqrt_vol_k).sum() - norm2_xs.mean()
+                b_hat_beta = 2 * omega_nk * (np.abs(g_ring_no_i_xs) * balls_info.sqrt_vol_k).sum() - norm2_xs.mean()
 
-            best_c_data.append((key_order(beta_info), b_hat_beta, np.array(coeff_i_vals).std(), num_alphas + cx + 1))
+            best_c_data.append((keys[cx], b_hat_beta, coeff_i_vals.std(), num_alphas + cx + 1))
 
         # calc best
         if len(best_c_data) > 0:
@@ -245,7 +328,7 @@ class SPWDE(object):
         else:
             name = 'WDE C = None'
             the_betas = []
-        pdf = self.calc_pdf_with_betas(dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at, alphas_dict, the_betas, name, subtitle)
+        pdf = self.calc_pdf_with_betas(dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at, alphas_table, the_betas, name, subtitle)
         if len(best_c_data) > 0:
             self.best_c_found = (pdf, best_c_data[pos_c])
             self.best_c_data = best_c_data
@@ -271,32 +354,20 @@ class SPWDE(object):
         #   wave_base_0_00_ZS, wave_base_0_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs
 
         # memoise balls
-        all_balls = []
-        for i in range(len(xs)):
-            balls = balls_no_i(balls_info, i)
-            all_balls.append(balls)
+        all_balls = all_balls_no_i(balls_info, self.dtype)
 
         # rank betas from large to smallest; we will incrementaly calculate
         # the HD_i for each in turn
         triple = dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at[(0, (0, 0))]
         _, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs = triple
-        alphas_dict = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, 0, xs, balls_info, (0, 0))
+        alphas_table = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info)
 
         # get base line for acummulated values by computing alphas and the
         # target HD_i functions
         # >> calculate alphas >> same as best_c
         _, wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs = dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at[(0, (0, 0))]
-        g_ring_no_i_xs = np.zeros(xs.shape[0])
-        norm2_xs = np.zeros(xs.shape[0])
-        for i, x in enumerate(xs):
-            coeff_no_i_0_00_ZS = self.calc_coeffs_no_i(wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs, 0, xs, i,
-                                                       balls_info, (0, 0))
-            for zs in coeff_no_i_0_00_ZS:
-                if zs not in wave_base_0_00_ZS_at_xs:
-                    continue
-                alpha_zs, alpha_d_zs = coeff_no_i_0_00_ZS[zs]
-                g_ring_no_i_xs[i] += alpha_zs * wave_base_0_00_ZS_at_xs[zs][i]
-                norm2_xs[i] += alpha_zs * alpha_d_zs
+        g_ring_no_i_xs, norm2_xs = self.calc_g_ring_no_i(wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs,
+                                                          xs, balls_info)
 
         ## print('g_ring_no_i_xs', g_ring_no_i_xs * g_ring_no_i_xs) << !!! OK !!!
 
@@ -310,9 +381,8 @@ class SPWDE(object):
                     for qq in qqs[1:]:
                         triple = dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at[(j, qq)]
                         _, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs = triple
-                        cc = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, j, xs, balls_info, qq)
-                        for zs in cc:
-                            coeff_zs, coeff_d_zs = cc[zs]
+                        cc = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info)
+                        for zs, coeff_zs, coeff_d_zs in zip(cc.zs_list, cc.alphas, cc.alphas_d):
                             if coeff_zs == 0.0:
                                 continue
                             curr_betas[(j, qq, zs)] = coeff_zs, coeff_d_zs
@@ -356,9 +426,9 @@ class SPWDE(object):
                 loc_g_ring_no_i_xs, loc_norm2_xs, betas_j_qq_zs_no_i = g_ring_calc(j, qq, zs)
 
                 if mode == self.MODE_NORMED:
-                    b_hat_beta = omega_nk * (np.sqrt(loc_g_ring_no_i_xs * loc_g_ring_no_i_xs / loc_norm2_xs) * balls_info.sqrt_vol_k).sum()
+                    b_hat_beta = omega_nk * (np.abs(loc_g_ring_no_i_xs) / np.sqrt(loc_norm2_xs) * balls_info.sqrt_vol_k).sum()
                 else:  # mode == self.MODE_DIFF:
-                    b_hat_beta = 2 * omega_nk * (np.sqrt(loc_g_ring_no_i_xs * loc_g_ring_no_i_xs) * balls_info.sqrt_vol_k).sum() - loc_norm2_xs.mean()
+                    b_hat_beta = 2 * omega_nk * (np.abs(loc_g_ring_no_i_xs) * balls_info.sqrt_vol_k).sum() - loc_norm2_xs.mean()
 
                 if len(betas_j_qq_zs_no_i) == 0:
                     continue
@@ -442,7 +512,7 @@ class SPWDE(object):
         print('')
         name = 'WDE greedy = %f' % curr_b_hat_beta
         the_betas_p = [tt[:6] for tt in the_betas]
-        pdf = self.calc_pdf_with_betas(dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at, alphas_dict, the_betas_p, name)
+        pdf = self.calc_pdf_with_betas(dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at, alphas_table, the_betas_p, name)
         self.best_c_found = (pdf, curr_b_hat_beta)
         self.best_c_data = [(ix, tt[5]) for ix, tt in enumerate(the_betas)]
 
@@ -463,32 +533,20 @@ class SPWDE(object):
         #   wave_base_0_00_ZS, wave_base_0_00_ZS_at_xs, wave_dual_j_00_ZS_at_xs
 
         # memoise balls
-        all_balls = []
-        for i in range(len(xs)):
-            balls = balls_no_i(balls_info, i)
-            all_balls.append(balls)
+        all_balls = all_balls_no_i(balls_info, self.dtype)
 
         # rank betas from large to smallest; we will incrementaly calculate
         # the HD_i for each in turn
         triple = dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at[(0, (0, 0))]
         _, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs = triple
-        alphas_dict = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, 0, xs, balls_info, (0, 0))
+        alphas_table = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info)
 
         # get base line for acummulated values by computing alphas and the
         # target HD_i functions
         # >> calculate alphas >> same as best_c
         _, wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs = dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at[(0, (0, 0))]
-        g_ring_no_i_xs = np.zeros(xs.shape[0])
-        norm2_xs = np.zeros(xs.shape[0])
-        for i, x in enumerate(xs):
-            coeff_no_i_0_00_ZS = self.calc_coeffs_no_i(wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs, 0, xs, i,
-                                                       balls_info, (0, 0))
-            for zs in coeff_no_i_0_00_ZS:
-                if zs not in wave_base_0_00_ZS_at_xs:
-                    continue
-                alpha_zs, alpha_d_zs = coeff_no_i_0_00_ZS[zs]
-                g_ring_no_i_xs[i] += alpha_zs * wave_base_0_00_ZS_at_xs[zs][i]
-                norm2_xs[i] += alpha_zs * alpha_d_zs
+        g_ring_no_i_xs, norm2_xs = self.calc_g_ring_no_i(wave_base_0_00_ZS_at_xs, wave_dual_0_00_ZS_at_xs,
+                                                          xs, balls_info)
 
         ## print('g_ring_no_i_xs', g_ring_no_i_xs * g_ring_no_i_xs) << !!! OK !!!
 
@@ -499,9 +557,8 @@ class SPWDE(object):
                 for qq in qqs[1:]:
                     triple = dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at[(j, qq)]
                     _, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs = triple
-                    cc = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, j, xs, balls_info, qq)
-                    for zs in cc:
-                        coeff_zs, coeff_d_zs = cc[zs]
+                    cc = self.calc_coeffs(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info)
+                    for zs, coeff_zs, coeff_d_zs in zip(cc.zs_list, cc.alphas, cc.alphas_d):
                         if coeff_zs == 0.0:
                             continue
                         curr_betas[(j, qq, zs)] = coeff_zs, coeff_d_zs
@@ -541,9 +598,9 @@ class SPWDE(object):
                 loc_g_ring_no_i_xs, loc_norm2_xs, betas_j_qq_zs_no_i = g_ring_calc(j, qq, zs)
 
                 if opt_target == self.TARGET_NORMED:
-                    b_hat_beta = omega_nk * (np.sqrt(loc_g_ring_no_i_xs * loc_g_ring_no_i_xs / loc_norm2_xs) * balls_info.sqrt_vol_k).sum()
+                    b_hat_beta = omega_nk * (np.abs(loc_g_ring_no_i_xs) / np.sqrt(loc_norm2_xs) * balls_info.sqrt_vol_k).sum()
                 else:  # mode == self.MODE_DIFF:
-                    b_hat_beta = 2 * omega_nk * (np.sqrt(loc_g_ring_no_i_xs * loc_g_ring_no_i_xs) * balls_info.sqrt_vol_k).sum() - loc_norm2_xs.mean()
+                    b_hat_beta = 2 * omega_nk * (np.abs(loc_g_ring_no_i_xs) * balls_info.sqrt_vol_k).sum() - loc_norm2_xs.mean()
 
                 if len(betas_j_qq_zs_no_i) == 0:
                     continue
@@ -594,27 +651,19 @@ class SPWDE(object):
         print('')
         name = 'WDE greedy = %f' % curr_b_hat_beta
         the_betas_p = [tt[:6] for tt in the_betas]
-        pdf = self.calc_pdf_with_betas(dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at, alphas_dict, the_betas_p, name)
+        pdf = self.calc_pdf_with_betas(dict_triple_J_QQ_ZS__wbase_wbase_at_wdual_at, alphas_table, the_betas_p, name)
         self.best_c_found = (pdf, curr_b_hat_beta)
         self.best_c_data = [(ix, tt[5]) for ix, tt in enumerate(the_betas)]
 
     def calc_pdf(self, base_fun, alphas, name):
-        norm2 = 0.0
-        for zs in alphas:
-            if zs not in base_fun:
-                continue
-            alpha_zs, alpha_d_zs = alphas[zs]
-            norm2 += alpha_zs * alpha_d_zs
+        rows = [row for row, zs in enumerate(alphas.zs_list) if zs in base_fun]
+        norm2 = (alphas.alphas[rows] * alphas.alphas_d[rows]).sum()
         if norm2 == 0.0:
             raise RuntimeError('No norm')
+        funs = [base_fun[alphas.zs_list[row]] for row in rows]
 
-        def pdf(xs, alphas=alphas, norm2=norm2, base_fun=base_fun):
-            g_ring_xs = np.zeros(xs.shape[0])
-            for zs in alphas:
-                if zs not in base_fun:
-                    continue
-                alpha_zs, alpha_d_zs = alphas[zs]
-                g_ring_xs += alpha_zs * base_fun[zs](xs)
+        def pdf(xs, alphas=alphas.alphas[rows], norm2=norm2, funs=funs):
+            g_ring_xs = np.tensordot(alphas, np.array([fun(xs) for fun in funs]), axes=1)
             # q_ring_x ^ 2 / norm2 == f_at_x
             return g_ring_xs * g_ring_xs / norm2
         pdf.name = name
@@ -622,35 +671,28 @@ class SPWDE(object):
 
     def calc_pdf_with_betas(self, base_funs_j, alphas, betas, name, subtitle=None):
         "Calculate the pdf for given alphas and betas"
-        norm2 = 0.0
+        coeffs = []
+        funs = []
         base_fun, _, _ = base_funs_j[(0, (0, 0))]
-        for zs in alphas:
+        for zs, alpha_zs, alpha_d_zs in zip(alphas.zs_list, alphas.alphas, alphas.alphas_d):
             if zs not in base_fun:
                 continue
-            alpha_zs, alpha_d_zs = alphas[zs]
-            norm2 += alpha_zs * alpha_d_zs
+            coeffs.append((alpha_zs, alpha_d_zs))
+            funs.append(base_fun[zs])
         for j, qq, zs, coeff_zs, coeff_d_zs, coeff_std in betas:
             base_fun, _, _ = base_funs_j[(j, qq)]
             if zs not in base_fun:
                 continue
-            norm2 += coeff_zs * coeff_d_zs
+            coeffs.append((coeff_zs, coeff_d_zs))
+            funs.append(base_fun[zs])
+        coeffs = np.array(coeffs).reshape(-1, 2)
+        norm2 = (coeffs[:, 0] * coeffs[:, 1]).sum()
 
         if norm2 == 0.0:
             raise RuntimeError('No norm')
 
-        def pdf(xs, alphas=alphas, betas=betas, norm2=norm2, base_funs_j=base_funs_j):
-            g_ring_xs = np.zeros(xs.shape[0])
-            base_fun, _, _ = base_funs_j[(0, (0, 0))]
-            for zs in alphas:
-                if zs not in base_fun:
-                    continue
-                alpha_zs, alpha_d_zs = alphas[zs]
-                g_ring_xs += alpha_zs * base_fun[zs](xs)
-            for j, qq, zs, coeff_zs, coeff_d_zs, coeff_std in betas:
-                base_fun, _, _ = base_funs_j[(j, qq)]
-                if zs not in base_fun:
-                    continue
-                g_ring_xs += coeff_zs * base_fun[zs](xs)
+        def pdf(xs, coeffs=coeffs[:, 0], norm2=norm2, funs=funs):
+            g_ring_xs = np.tensordot(coeffs, np.array([fun(xs) for fun in funs]), axes=1)
             # q_ring_x ^ 2 / norm2 == f_at_x
             return g_ring_xs * g_ring_xs / norm2
         pdf.name = name
@@ -667,14 +709,12 @@ class SPWDE(object):
             funs[zs] = base-wave _{j,zs}^{(qq)}
             base @ xs[zs] = base-wave _{j,zs}^{(qq)}(xs)
             dual @ xs[zs] = dual-wave _{j,zs}^{(qq)}(xs)
+            where base @ xs and dual @ xs are ZsValues
         """
         wave_base_j_qq_ZS, wave_dual_j_qq_ZS = self.calc_funs(j, qq)
-        base_fun_xs = {}
-        for zs in wave_base_j_qq_ZS:
-            base_fun_xs[zs] = wave_base_j_qq_ZS[zs](xs)
-        dual_fun_xs = {}
-        for zs in wave_dual_j_qq_ZS:
-            dual_fun_xs[zs] = wave_dual_j_qq_ZS[zs](xs)
+        base_fun_xs = calc_zs_values(wave_base_j_qq_ZS, xs, self.dtype)
+        dual_fun_xs = calc_zs_values(wave_dual_j_qq_ZS, xs, self.dtype)
+        dual_fun_xs.common_rows, base_fun_xs.common_rows = dual_fun_xs.intersect(base_fun_xs)
         return wave_base_j_qq_ZS, base_fun_xs, dual_fun_xs
 
     def calc_funs(self, j, qq):
@@ -685,91 +725,167 @@ class SPWDE(object):
             funs[zs] = base|dual wave _{j,zs}^{(qq)}
             wave_base_j_qq_ZS, wave_dual_j_qq_ZS
         """
-        jj = [j + j0 for j0 in self.j0s]
-        jpow2 = np.array([2 ** j for j in jj])
-
+        jpow2, zs_ranges = self._level_meta(j, qq)
         funs = {}
         for what in ['dual', 'base']:
-            zs_min, zs_max = self.wave.z_range(what, (qq, jpow2, None), self.minx, self.maxx)
+            zs_min, zs_max = zs_ranges[what]
             funs[what] = {}
-            for zs in itt.product(*all_zs_tensor(zs_min, zs_max)):
+            for zs in map(tuple, all_zs_array(zs_min, zs_max).tolist()):
                 funs[what][zs] = self.wave.fun_ix(what, (qq, jpow2, zs))
         return funs['base'], funs['dual']
 
-    def calc_coeffs(self, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, j, xs, balls_info, qq):
-        jj = [j + j0 for j0 in self.j0s]
-        jpow2 = np.array([2 ** j for j in jj])
-        zs_min, zs_max = self.wave.z_range('dual', (qq, jpow2, None), self.minx, self.maxx)
+    def _level_meta(self, j, qq):
+        """
+        :return: (jpow2, zs_ranges) for level j and tensor index qq, where
+            zs_ranges[what] = (zs_min, zs_max) covering (minx, maxx) for what in 'dual', 'base'
+        """
+        key = (j, qq)
+        if key not in self._level_meta_cache:
+            jpow2 = np.array([2 ** (j + j0) for j0 in self.j0s])
+            zs_ranges = {what: self.wave.z_range(what, (qq, jpow2, None), self.minx, self.maxx)
+                         for what in ['dual', 'base']}
+            self._level_meta_cache[key] = (jpow2, zs_ranges)
+        return self._level_meta_cache[key]
+
+    def calc_coeffs(self, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info):
+        "Calculate alphas (w/ dual) and alpha-duals (w/ base) as a CoeffTable over zs in dual"
         omega = calc_omega(xs.shape[0], self.k)
-        resp = {}
         balls = balls_info.sqrt_vol_k
-        for zs in itt.product(*all_zs_tensor(zs_min, zs_max)):
-            alpha_zs = omega * (wave_dual_j_qq_ZS_at_xs[zs] * balls).sum()
-            resp[zs] = (alpha_zs, alpha_zs)
+        zs_list = wave_dual_j_qq_ZS_at_xs.zs_list
+        alphas = omega * weighted_sums(wave_dual_j_qq_ZS_at_xs.values, balls)
         if self.wave.orthogonal:
             # we are done
-            return resp
-        zs_min, zs_max = self.wave.z_range('base', (qq, jpow2, None), self.minx, self.maxx)
-        for zs in itt.product(*all_zs_tensor(zs_min, zs_max)):
-            if zs not in resp:
-                continue
-            alpha_d_zs = omega * (wave_base_j_qq_ZS_at_xs[zs] * balls).sum()
-            resp[zs] = (resp[zs][0], alpha_d_zs)
-        return resp
-
-    def calc_coeffs_no_i(self, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, j, xs, i, balls_info, qq):
-        "Calculate alphas (w/ dual) and alpha-duals (w/ base)"
-        jj = [j + j0 for j0 in self.j0s]
-        jpow2 = np.array([2 ** j for j in jj])
-        zs_min, zs_max = self.wave.z_range('dual', (qq, jpow2, None), self.minx, self.maxx)
+            return CoeffTable(zs_list, alphas, alphas)
+        alphas_d = alphas.copy()
+        base_rows, dual_rows = common_rows(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs)
+        alphas_d[dual_rows] = omega * weighted_sums(wave_base_j_qq_ZS_at_xs.values[base_rows], balls)
+        return CoeffTable(zs_list, alphas, alphas_d)
+
+    def calc_coeffs_no_i(self, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info):
+        """
+        Calculate alphas (w/ dual) and alpha-duals (w/ base) leaving out each sample in turn,
+        for all zs in both systems
+
+        :return: (zs_list, alphas, alphas_d), alphas[r, i] is the coefficient for zs_list[r] without xs[i]
+        """
         omega_no_i = calc_omega(xs.shape[0] - 1, self.k)
-        resp = {}
-        vol_no_i = balls_no_i(balls_info, i)
-        for zs in itt.product(*all_zs_tensor(zs_min, zs_max)):
-            # below, we remove factor for i from sum << this has the biggest impact in performance
-            # also, we calculated alpha_zs previously and cen be further optimised w/ calc_coeffs
-            alpha_zs = omega_no_i * ((wave_dual_j_qq_ZS_at_xs[zs] * vol_no_i).sum() - wave_dual_j_qq_ZS_at_xs[zs][i] * vol_no_i[i])
-            resp[zs] = (alpha_zs, alpha_zs)
+        base_rows, dual_rows = common_rows(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs)
+        zs_list = [wave_dual_j_qq_ZS_at_xs.zs_list[row] for row in dual_rows]
+        dual_xs = wave_dual_j_qq_ZS_at_xs.values[dual_rows]
+        alphas = omega_no_i * sums_no_i(dual_xs, balls_info)
         if self.wave.orthogonal:
             # we are done
-            return resp
-        zs_min, zs_max = self.wave.z_range('base', (qq, jpow2, None), self.minx, self.maxx)
-        for zs in itt.product(*all_zs_tensor(zs_min, zs_max)):
-            if zs not in resp:
-                continue
-            # below, we remove factor for i from sum << this has the biggest impact in performance
-            alpha_d_zs = omega_no_i * ((wave_base_j_qq_ZS_at_xs[zs] * vol_no_i).sum() - wave_base_j_qq_ZS_at_xs[zs][i] * vol_no_i[i])
-            resp[zs] = (resp[zs][0], alpha_d_zs)
-        return resp
+            return zs_list, alphas, alphas
+        base_xs = wave_base_j_qq_ZS_at_xs.values[base_rows]
+        alphas_d = omega_no_i * sums_no_i(base_xs, balls_info)
+        return zs_list, alphas, alphas_d
+
+    def calc_g_ring_no_i(self, wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs, xs, balls_info):
+        "Calculate g_ring and norm2 at each xs[i] with coefficients that leave out xs[i]"
+        _, alphas, alphas_d = self.calc_coeffs_no_i(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs,
+                                                    xs, balls_info)
+        base_rows, _ = common_rows(wave_base_j_qq_ZS_at_xs, wave_dual_j_qq_ZS_at_xs)
+        base_xs = wave_base_j_qq_ZS_at_xs.values[base_rows]
+        return (alphas * base_xs).sum(axis=0), (alphas * alphas_d).sum(axis=0)
 
     def calc_1_coeff_no_i(self, base_fun_xs, dual_fun_xs, j, xs, i, balls, qq, zs):
         omega_no_i = calc_omega(xs.shape[0] - 1, self.k)
+        # rows may be stored in float32 (see `SPWDE.dtype`), but the sums are taken in float64
+        balls = balls.astype(np.float64, copy=False)
         if zs in dual_fun_xs:
-            coeff = omega_no_i * ((dual_fun_xs[zs] * balls).sum() - dual_fun_xs[zs][i] * balls[i])
+            vals = dual_fun_xs[zs].astype(np.float64, copy=False)
+            coeff = omega_no_i * ((vals * balls).sum() - vals[i] * balls[i])
         else:
             coeff = 0.0
         if self.wave.orthogonal:
             # we are done
             return coeff, coeff
         if zs in base_fun_xs:
-            coeff_d = omega_no_i * ((base_fun_xs[zs] * balls).sum() - base_fun_xs[zs][i] * balls[i])
+            vals = base_fun_xs[zs].astype(np.float64, copy=False)
+            coeff_d = omega_no_i * ((vals * balls).sum() - vals[i] * balls[i])
         else:
             coeff_d = 0.0
         return coeff, coeff_d
 
-
-def balls_no_i(balls_info, i):
-    n = balls_info.nn_indexes.shape[0]
-    resp = []
-    for i_prim in range(n):
-        # note index i is removed at callers site
-        if i in balls_info.nn_indexes[i_prim, :-1]:
-            resp.append(balls_info.sqrt_vol_k_plus_1[i_prim])
+    def calc_1_coeff_no_i_all(self, base_fun_xs, dual_fun_xs, xs, balls_info, zs, deltas=None):
+        "Same as `calc_1_coeff_no_i` for `zs`, with the coefficients leaving out each i as vectors"
+        omega_no_i = calc_omega(xs.shape[0] - 1, self.k)
+        if zs in dual_fun_xs:
+            coeff = omega_no_i * sums_no_i(dual_fun_xs[zs][np.newaxis, :], balls_info, deltas)[0]
+        else:
+            coeff = np.zeros(xs.shape[0])
+        if self.wave.orthogonal:
+            # we are done
+            return coeff, coeff
+        if zs in base_fun_xs:
+            coeff_d = omega_no_i * sums_no_i(base_fun_xs[zs][np.newaxis, :], balls_info, deltas)[0]
         else:
-            resp.append(balls_info.sqrt_vol_k[i_prim])
-    return np.array(resp)
+            coeff_d = np.zeros(xs.shape[0])
+        return coeff, coeff_d
+
+
+def calc_zs_values(funs, xs, dtype=np.float64):
+    "Evaluates funs[zs] at xs for all zs and returns the ZsValues, with values stored as dtype"
+    zs_array = np.array(list(funs), dtype=int).reshape(len(funs), xs.shape[1])
+    values = np.empty((len(funs), xs.shape[0]), dtype=dtype)
+    for row, zs in enumerate(funs):
+        values[row] = funs[zs](xs)
+    return ZsValues(zs_array, values)
+
 
+def common_rows(base_fun_xs, dual_fun_xs):
+    "(base rows, dual rows) of zs in both systems; uses the rows from `SPWDE.calc_funs_at` when set"
+    if base_fun_xs.common_rows is None or dual_fun_xs.common_rows is None:
+        dual_rows, base_rows = dual_fun_xs.intersect(base_fun_xs)
+        return base_rows, dual_rows
+    return base_fun_xs.common_rows, dual_fun_xs.common_rows
 
+
+def balls_no_i(balls_info, i):
+    # note index i is removed at callers site
+    is_nn = (balls_info.nn_indexes[:, :-1] == i).any(axis=1)
+    return np.where(is_nn, balls_info.sqrt_vol_k_plus_1, balls_info.sqrt_vol_k)
+
+
+def all_balls_no_i(balls_info, dtype=np.float64):
+    "Matrix with `balls_no_i(balls_info, i)` as row i, for all i, stored as dtype"
+    n, m = balls_info.nn_indexes.shape
+    # is_nn[i, i_prim] == True iff i is within the k nearest neighbours of i_prim (or i_prim itself)
+    is_nn = np.zeros((n, n), dtype=bool)
+    is_nn[balls_info.nn_indexes[:, :-1].ravel(), np.repeat(np.arange(n), m - 1)] = True
+    return np.where(is_nn, balls_info.sqrt_vol_k_plus_1.astype(dtype), balls_info.sqrt_vol_k.astype(dtype))
+
+
+def balls_no_i_deltas(balls_info):
+    "Sparse matrix with `balls_no_i(balls_info, i) - balls_info.sqrt_vol_k` as row i, for all i"
+    n, m = balls_info.nn_indexes.shape
+    # entries at [i, i_prim] where i is within the k nearest neighbours of i_prim (or i_prim itself)
+    i_prims = np.repeat(np.arange(n), m - 1)
+    deltas = (balls_info.sqrt_vol_k_plus_1 - balls_info.sqrt_vol_k)[i_prims]
+    return csr_matrix((deltas, (balls_info.nn_indexes[:, :-1].ravel(), i_prims)), shape=(n, n))
+
+
+def sums_no_i(values, balls_info, deltas=None):
+    """
+    For values of shape (m, n), returns the (m, n) matrix with
+        sum_{i_prim != i} values[r, i_prim] * balls_no_i(balls_info, i)[i_prim]
+    at [r, i]. This is the full sum with sqrt_vol_k plus a correction for the
+    (k+1) balls changed by leaving out each i; `deltas` can be passed in from
+    `balls_no_i_deltas` when calling repeatedly with the same balls
+    """
+    if deltas is None:
+        deltas = balls_no_i_deltas(balls_info)
+    balls_ii = balls_info.sqrt_vol_k + deltas.diagonal()
+    full_sums = weighted_sums(values, balls_info.sqrt_vol_k)
+    return full_sums[:, np.newaxis] + (deltas @ values.T).T - values * balls_ii
+
+
+def weighted_sums(values, weights):
+    "values @ weights computed in the dtype of values, returned as float64"
+    return (values @ weights.astype(values.dtype, copy=False)).astype(np.float64, copy=False)
+
+
+@lru_cache(maxsize=128)
 def calc_omega(n, k):
     "Bias correction for k-th nearest neighbours sum for sample size n"
     return math.sqrt(n - 1) * gamma(k) / gamma(k + 0.5) / n
@@ -778,20 +894,25 @@ def calc_omega(n, k):
 
 BallsInfo = namedtuple('BallsInfo', ['sqrt_vol_k', 'sqrt_vol_k_plus_1', 'nn_indexes'])
 
+# alphas[r] and alphas_d[r] are the coefficients (w/ dual and base resp.) for zs_list[r]
+CoeffTable = namedtuple('CoeffTable', ['zs_list', 'alphas', 'alphas_d'])
+
 
 def calc_sqrt_vs(xs, k):
     "Returns BallsInfo object with sqrt of volumes of k-th balls and (k+1)-th balls"
     dim = xs.shape[1]
-    ball_tree = BallTree(xs)
+    # kd-tree is faster than a ball tree for the low dimensions used here
+    kd_tree = KDTree(xs, leaf_size=40, metric='euclidean')
     # as xs is both data and query, xs's nearest neighbour would be xs itself, hence the k+2 below
-    dist, inx = ball_tree.query(xs, k + 2)
+    dist, inx = kd_tree.query(xs, k + 2, return_distance=True, sort_results=True)
     k_near_radious = dist[:, -2:]
-    xs_balls_both = np.power(k_near_radious, dim / 2)
-    xs_balls = xs_balls_both[:, 0] * sqrt_vunit(dim)
-    xs_balls2 = xs_balls_both[:, 1] * sqrt_vunit(dim)
+    xs_balls_both = half_dim_power(k_near_radious, dim) * sqrt_vunit(dim)
+    xs_balls = xs_balls_both[:, 0]
+    xs_balls2 = xs_balls_both[:, 1]
     return BallsInfo(xs_balls, xs_balls2, inx)
 
 
+@lru_cache(maxsize=128)
 def sqrt_vunit(dim):
     "Square root of Volume of unit hypersphere in d dimensions"
     return math.sqrt((np.pi ** (dim / 2)) / gamma(dim / 2 + 1))
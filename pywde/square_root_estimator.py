@@ -2,15 +2,31 @@ import math
 import numpy as np
 import itertools as itt
 from collections import namedtuple, OrderedDict
-from .common import all_zs_tensor
-from sklearn.neighbors import BallTree
+from .common import all_zs_array, half_dim_power
+from scipy.spatial import cKDTree
 from scipy.special import gamma
-from datetime import datetime
+import time
+from types import MappingProxyType
+from joblib import Parallel, delayed
 
 from .pywt_ext import WaveletTensorProduct
 
 ThresholdResult = namedtuple('ThresholdResult', ['threshold', 'pos_k', 'target_val', 'values', 'sorted_contrib', 'th_j', 'msg'])
 
+# coeffs dict as parallel arrays; coeff[r], coeff_b[r], num[r] are the values for keys[r]
+CoeffArrays = namedtuple('CoeffArrays', ['keys', 'coeff', 'coeff_b', 'num'])
+
+
+def as_coeff_arrays(coeffs):
+    "CoeffArrays for a dict of key => (coeff, coeff_b, num)"
+    values = list(coeffs.values())
+    return CoeffArrays(
+        list(coeffs.keys()),
+        np.array([tup[0] for tup in values], dtype=float),
+        np.array([tup[1] for tup in values], dtype=float),
+        np.array([tup[2] for tup in values], dtype=np.int64),
+    )
+
 # from scipy cookbook
 def smooth(x, window_len=11, window='hanning'):
     """smooth the data using a window with requested size.
@@ -56,6 +72,9 @@ def smooth(x, window_len=11, window='hanning'):
     if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
         raise ValueError("Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
 
+    if window_len == 5 and window == 'hanning':
+        return _smooth_hanning5(x)
+
     s = np.r_[x[window_len - 1:0:-1], x, x[-2:-window_len - 1:-1]]
     # print(len(s))
     if window == 'flat':  # moving average
@@ -66,22 +85,118 @@ def smooth(x, window_len=11, window='hanning'):
     y = np.convolve(w / w.sum(), s, mode='valid')
     return y
 
+def _smooth_hanning5(x):
+    "Same as smooth(x, 5, 'hanning'); the window is (0, 1/4, 1/2, 1/4, 0), so it is a 3-tap sum of slices"
+    s = np.concatenate((x[4:0:-1], x, x[-2:-6:-1]))
+    y = 0.5 * s[2:-2]
+    y += 0.25 * (s[1:-3] + s[3:-1])
+    return y
+
 class WParams(object):
     def __init__(self, wde, with_betas=True):
         self.k = wde.k
         self.wave = wde.wave
         self.jj0 = wde.jj0
         self.delta_j = wde.delta_j
-        self.coeffs = {}
+        self.n_jobs = wde.n_jobs
+        self.cache_terms = wde.cache_terms
+        self.jpow2_cache = {}
+        # key => (dual, base) function values at terms_xs, see calc_coeffs
+        self.terms_cache = {}
+        self.terms_xs = None
+        self._clear_coeffs()
         self.minx = wde.minx
         self.maxx = wde.maxx
         self._calc_indexes(with_betas)
         self.n = 0
+        self.omega_n = self.omega_n1 = self.omega_n2 = self.omega_ratio = None
         self.pdf = None
         self.test = None
         self.ball_tree = None
         self.xs_balls = None
         self.xs_balls_inx = None
+        self.xs_balls_sq = None
+        self.xs_balls_delta = None
+        self.xs_near_inx = None
+
+    def _clear_coeffs(self):
+        # coefficients are kept as parallel arrays, coeff[r], coeff_b[r], num[r] are the
+        # values for keys[r] once done[r]; key_pos[key] = r; is_alpha[r] tags alpha keys
+        self.keys = []
+        self.key_pos = {}
+        self.coeff = np.zeros(0)
+        self.coeff_b = np.zeros(0)
+        self.num = np.zeros(0, dtype=np.int64)
+        self.done = np.zeros(0, dtype=bool)
+        self.is_alpha = np.zeros(0, dtype=bool)
+        self._coeffs = None
+
+    def _append_keys(self, new_keys, is_alpha):
+        "Adds new_keys, all pending calculation; is_alpha tags them as alphas, as a bool for all or one per key"
+        pos0 = len(self.keys)
+        self.keys.extend(new_keys)
+        self.key_pos.update(zip(new_keys, range(pos0, len(self.keys))))
+        size = len(new_keys)
+        self.coeff = np.concatenate((self.coeff, np.zeros(size)))
+        self.coeff_b = np.concatenate((self.coeff_b, np.zeros(size)))
+        self.num = np.concatenate((self.num, np.zeros(size, dtype=np.int64)))
+        self.done = np.concatenate((self.done, np.zeros(size, dtype=bool)))
+        tags = np.empty(size, dtype=bool)
+        tags[:] = is_alpha
+        self.is_alpha = np.concatenate((self.is_alpha, tags))
+        self._coeffs = None
+
+    def _drop_rows(self, rows):
+        "Removes keys at positions rows, keeping the order of the rest"
+        if len(rows) == 0:
+            return
+        keep = np.ones(len(self.keys), dtype=bool)
+        keep[rows] = False
+        self.keys = [key for key, kept in zip(self.keys, keep) if kept]
+        self.key_pos = {key: pos for pos, key in enumerate(self.keys)}
+        self.coeff = self.coeff[keep]
+        self.coeff_b = self.coeff_b[keep]
+        self.num = self.num[keep]
+        self.done = self.done[keep]
+        self.is_alpha = self.is_alpha[keep]
+        self._coeffs = None
+
+    @property
+    def coeffs(self):
+        """Read-only mapping of key => (coeff, coeff_b, num), or None while pending; built on demand
+        from the arrays, so writes go through the setter (or the arrays) and never to a stale copy"""
+        if self._coeffs is None:
+            self._coeffs = MappingProxyType({
+                key: (self.coeff[pos], self.coeff_b[pos], self.num[pos]) if self.done[pos] else None
+                for pos, key in enumerate(self.keys)
+            })
+        return self._coeffs
+
+    @coeffs.setter
+    def coeffs(self, coeffs):
+        self._clear_coeffs()
+        if len(coeffs) == 0:
+            return
+        self._append_keys(list(coeffs.keys()), [is_alpha_key(key) for key in coeffs.keys()])
+        for pos, tup in enumerate(coeffs.values()):
+            if tup is not None:
+                self.coeff[pos], self.coeff_b[pos], self.num[pos] = tup
+                self.done[pos] = True
+
+    def _store_coeffs(self, rows, results):
+        "Stores (coeff, coeff_b, num) results for pending rows, dropping negligible ones; returns kept norm"
+        norm = 0.0
+        remove = []
+        for row, (coeff, coeff_b, num) in zip(rows, results):
+            if math.fabs(coeff) < 1.0e-7 and math.fabs(coeff_b) < 1.0e-7:
+                remove.append(row)
+                continue
+            self.coeff[row], self.coeff_b[row], self.num[row] = coeff, coeff_b, num
+            self.done[row] = True
+            norm += coeff * coeff_b
+        self._coeffs = None
+        self._drop_rows(remove)
+        return norm
 
     def to_dict(self):
         return dict(
@@ -89,7 +204,7 @@ class WParams(object):
             wave=self.wave.to_dict(),
             jj0=self.jj0.tolist(),
             delta_j=self.delta_j,
-            coeffs=self.coeffs,
+            coeffs=dict(self.coeffs),
         )
 
     @staticmethod
@@ -98,37 +213,51 @@ class WParams(object):
 
     def pre_coeffs(self, xs):
         self.n = xs.shape[0]
-        self.ball_tree = BallTree(xs)
+        # omega only depends on n, so do it once per sample, not per key
+        self.omega_n = self.omega(self.n)
+        self.omega_n1 = self.omega(self.n - 1)
+        self.omega_n2 = self.omega_n * self.omega_n1
+        self.omega_ratio = self.omega_n1 / self.omega_n
+        self.ball_tree = self.nn_tree(xs)
         self.calculate_nearest_balls(xs)
 
     def calc_coeffs(self, xs):
-        norm = 0.0
-        omega = self.omega(self.n)
-        remove = []
-        for key in self.coeffs.keys():
-            if self.coeffs[key] is not None:
-                continue
-            j, qx, zs, jpow2 = key
-            jpow2 = np.array(jpow2)
-            num = self.wave.supp_ix('dual', (qx, jpow2, zs))(xs).sum()
-            terms_d = self.wave.fun_ix('dual', (qx, jpow2, zs))(xs)
-            terms_b = self.wave.fun_ix('base', (qx, jpow2, zs))(xs)
-            coeff = (terms_d * self.xs_balls).sum() * omega
-            coeff_b = (terms_b * self.xs_balls).sum() * omega
-            #print('beta_{%s}' % str(key), '=', coeff)
-            if math.fabs(coeff) < 1.0e-7 and math.fabs(coeff_b) < 1.0e-7:
-                remove.append(key)
-                continue
-            self.coeffs[key] = (coeff, coeff_b, num)
-            norm += coeff * coeff_b
-        for key in remove:
-            del self.coeffs[key]
-        print('calc_coeffs #', len(self.coeffs), norm)
+        omega = self.omega_n
+        rows = np.flatnonzero(~self.done)
+        keys = [self.keys[row] for row in rows]
+        if self.n_jobs is None:
+            results = [self._calc_coeff(key, xs, self.xs_balls, omega, self.cache_terms) for key in keys]
+        else:
+            # keys are independent and numpy releases the GIL, so threads are enough
+            results = Parallel(n_jobs=self.n_jobs, prefer='threads')(
+                delayed(self._calc_coeff)(key, xs, self.xs_balls, omega, self.cache_terms) for key in keys
+            )
+        if self.cache_terms and self.terms_xs is not xs:
+            self.terms_cache = {}
+            self.terms_xs = xs
+        norm = self._store_coeffs(rows, [tup for tup, _ in results])
+        if self.cache_terms:
+            for key, (_, terms) in zip(keys, results):
+                if key in self.key_pos:
+                    self.terms_cache[key] = terms
+        print('calc_coeffs #', len(self.keys), norm)
+
+    def _calc_coeff(self, key, xs, balls, omega, with_terms=False):
+        """Returns (coeff, coeff_b, num), (dual, base) values at xs for key, with the given balls for xs;
+        the values are None unless `with_terms`, so they can be freed as soon as the key is done"""
+        j, qx, zs, jpow2 = key
+        jpow2 = self._jpow2(j)
+        terms_d, supp_d = self.wave.fun_supp_ix('dual', (qx, jpow2, zs))(xs)
+        num = supp_d.sum()
+        terms_b = self.wave.fun_ix('base', (qx, jpow2, zs))(xs)
+        coeff = np.dot(terms_d, balls) * omega
+        coeff_b = np.dot(terms_b, balls) * omega
+        if not with_terms:
+            return (coeff, coeff_b, num), None
+        return (coeff, coeff_b, num), (terms_d, terms_b)
 
     def calc_coeffs_loo(self, xs, ix_loo):
-        norm = 0.0
         omega = self.omega(self.n - 1)
-        remove = []
         xs = np.delete(xs, ix_loo, axis=0)
         balls = []
         for i in range(self.xs_balls_inx.shape[0]):
@@ -139,46 +268,38 @@ class WParams(object):
             else:
                 balls.append(self.xs_balls[i])
         balls = np.array(balls)
-        for key in self.coeffs.keys():
-            if self.coeffs[key] is not None:
-                continue
-            j, qx, zs, jpow2 = key
-            jpow2 = np.array(jpow2)
-            num = self.wave.supp_ix('dual', (qx, jpow2, zs))(xs).sum()
-            terms_d = self.wave.fun_ix('dual', (qx, jpow2, zs))(xs)
-            terms_b = self.wave.fun_ix('base', (qx, jpow2, zs))(xs)
-            coeff = (terms_d * balls).sum() * omega
-            coeff_b = (terms_b * balls).sum() * omega
-            #print('beta_{%s}' % str(key), '=', coeff)
-            if math.fabs(coeff) < 1.0e-7 and math.fabs(coeff_b) < 1.0e-7:
-                remove.append(key)
-                continue
-            self.coeffs[key] = (coeff, coeff_b, num)
-            norm += coeff * coeff_b
-        for key in remove:
-            del self.coeffs[key]
-        # print('calc_coeffs #', len(self.coeffs), norm)
+        rows = np.flatnonzero(~self.done)
+        results = [self._calc_coeff(self.keys[row], xs, balls, omega)[0] for row in rows]
+        self._store_coeffs(rows, results)
+        # print('calc_coeffs #', len(self.keys))
 
 
     def calc_pdf(self, coeffs):
+        # a plain copy, as coeffs may be the read-only view of `WParams.coeffs`
+        coeffs = dict(coeffs)
+        arrays = as_coeff_arrays(coeffs)
+        base_funs = []
+        for key in arrays.keys:
+            j, qx, zs, jpow2 = key
+            base_funs.append(self.wave.fun_ix('base', (qx, self._jpow2(j), zs)))
+
         def fun(coords):
-            xs_sum = self.xs_sum_zeros(coords)
-            for key in coeffs.keys():
-                j, qx, zs, jpow2 = key
-                jpow2 = np.array(jpow2)
-                coeff, coeff_b, num = coeffs[key]
-                vals = coeff * self.wave.fun_ix('base', (qx, jpow2, zs))(coords)
-                xs_sum += vals
+            if len(base_funs) == 0:
+                xs_sum = self.xs_sum_zeros(coords)
+            else:
+                # phi[r] = base function for r-th key at coords
+                phi = np.stack([base_fun(coords) for base_fun in base_funs])
+                xs_sum = np.tensordot(arrays.coeff, phi, axes=1)
             return (xs_sum * xs_sum) / fun.norm_const
 
         def to_dict(a_fun):
             return {'coeffs': coeffs}
 
-        fun.norm_const = sum([coeff * coeff_b for coeff, coeff_b, num in coeffs.values()])
+        fun.norm_const = (arrays.coeff * arrays.coeff_b).sum()
         fun.dim = self.wave.dim
         fun.nparams = len(coeffs)
         fun.to_dict = to_dict
-        min_num = min([num for coeff, coeff_b, num in coeffs.values() if num > 0])
+        min_num = arrays.num[arrays.num > 0].min()
         # print('>> WDE PDF')
         # print('Num coeffs', len(coeffs))
         # print('Norm', fun.norm_const)
@@ -186,56 +307,71 @@ class WParams(object):
         return fun
 
     def gen_pdf(self, xs_sum, coeffs_items, coords):
-        norm_const = 0.0
-        for key, tup in coeffs_items:
-            j, qx, zs, jpow2 = key
-            jpow2 = np.array(jpow2)
-            coeff, coeff_b, num = tup
-            vals = coeff * self.wave.fun_ix('base', (qx, jpow2, zs))(coords)
-            norm_const += coeff * coeff_b
-            xs_sum += vals
-            yield key, (xs_sum * xs_sum) / norm_const
+        "Yields (key, pdf at coords) adding one key at a time to xs_sum (which is left unchanged)"
+        arrays = as_coeff_arrays(OrderedDict(coeffs_items))
+        if len(arrays.keys) == 0:
+            return
+        phi = np.stack([
+            self.wave.fun_ix('base', (qx, self._jpow2(j), zs))(coords)
+            for j, qx, zs, jpow2 in arrays.keys
+        ])
+        # partial[r] = xs_sum + sum of contributions of first r + 1 keys
+        weights = arrays.coeff.reshape((-1,) + (1,) * (phi.ndim - 1))
+        partial = np.cumsum(weights * phi, axis=0) + xs_sum
+        norm_consts = np.cumsum(arrays.coeff * arrays.coeff_b)
+        for key, xs_sum_k, norm_const in zip(arrays.keys, partial, norm_consts):
+            yield key, (xs_sum_k * xs_sum_k) / norm_const
 
     def calc_terms(self, key, coeff, coeff_b, xs):
         # see paper, Q definition
+        term1, term2, term3, coeff2 = self.calc_terms_all([key], np.array([coeff]), np.array([coeff_b]), xs)
+        return term1[0], term2[0], term3[0], coeff2[0]
+
+    # keys per block in calc_terms_all, so temporaries take O(block * n * k) memory whatever the #keys
+    TERMS_BLOCK = 256
+
+    def calc_terms_all(self, keys, coeffs, coeffs_b, xs):
+        "Same as `calc_terms` for a list of keys at once; returns arrays aligned with keys"
         if self.xs_balls_inx is None:
             raise ValueError('Use calc_coeffs first')
 
-        j, qx, zs, jpow2 = key
-        jpow2 = np.array(jpow2)
+        coeffs2 = coeffs * coeffs_b
+        term1 = self.omega_ratio * coeffs2
+        term2 = np.zeros(len(keys))
+        term3 = np.zeros(len(keys))
+        for start in range(0, len(keys), self.TERMS_BLOCK):
+            block = slice(start, start + self.TERMS_BLOCK)
+            term2[block], term3[block] = self._calc_terms_block(keys[block], xs)
+        return term1, term2, term3, coeffs2
+
+    def _calc_terms_block(self, keys, xs):
+        "(term2, term3) arrays for keys, see `calc_terms_all`"
+        # F_d[r], F_b[r] = dual, base function for keys[r] at xs
+        F_d = np.empty((len(keys), xs.shape[0]))
+        F_b = np.empty((len(keys), xs.shape[0]))
+        cache = self.terms_cache if xs is self.terms_xs else {}
+        for row, key in enumerate(keys):
+            if key in cache:
+                F_d[row], F_b[row] = cache[key]
+                continue
+            j, qx, zs, jpow2 = key
+            jpow2 = self._jpow2(j)
+            F_d[row] = self.wave.fun_ix('dual', (qx, jpow2, zs))(xs)
+            F_b[row] = self.wave.fun_ix('base', (qx, jpow2, zs))(xs)
+        omega_n2 = self.omega_n2
 
-        # import code
-        # code.interact('calc_terms **', local=locals())
-
-        fun_i_dual = self.wave.fun_ix('dual', (qx, jpow2, zs))(xs)
-        fun_i_base = self.wave.fun_ix('base', (qx, jpow2, zs))(xs)
-        omega_n = self.omega(self.n)
-        omega_n1 = self.omega(self.n-1)
-        omega_n2 = omega_n * omega_n1
-
-        term1 = omega_n1 / omega_n * coeff * coeff_b
-
-        term2 = omega_n2 * (fun_i_dual * fun_i_base * self.xs_balls * self.xs_balls).sum()
-
-        vals_i = np.zeros(self.n)
-        obj = self
-        for j in range(self.n):
-            psi_j = fun_i_dual[j]
-            deltaV_j = self.xs_balls2[j] - self.xs_balls[j]
-            # TODO: what if just do k = self.k ?? (or even k=1) ??
-            ## for k in [self.k - 1]:
-            for k in range(self.k):
-                i = self.xs_balls_inx[j, k+1] # position 0 is x_j
-                psi_i = fun_i_base[i]
-                v1_i = self.xs_balls[i]
-                v = psi_i * psi_j * v1_i * deltaV_j
-                vals_i[i] += v
-        term3 = omega_n2 * vals_i.sum()
-        return term1, term2, term3, coeff * coeff_b
+        term2 = omega_n2 * ((F_d * F_b) @ self.xs_balls_sq)
+
+        # for each x_j and its k nearest neighbours x_i (position 0 is x_j itself),
+        #   psi_i * psi_j * v1_i * deltaV_j; only the total is needed, so sum over i first
+        # TODO: what if just do k = self.k ?? (or even k=1) ??
+        near_b = (F_b * self.xs_balls)[:, self.xs_near_inx].sum(axis=2)
+        term3 = omega_n2 * np.einsum('kn,kn->k', F_d * self.xs_balls_delta, near_b)
+        return term2, term3
 
     def calc1(self, key, tup, coords, norm):
         j, qx, zs, jpow2 = key
-        jpow2 = np.array(jpow2)
+        jpow2 = self._jpow2(j)
         coeff, num = tup
         vals = coeff * self.wave.fun_ix('base', (qx, jpow2, zs))(coords)
         return vals, norm + coeff*coeff
@@ -263,8 +399,7 @@ class WParams(object):
         print("# calc'ed beta coeffs %d =" % j, betas)
 
     def _calc_indexes_j(self, j, qxs):
-        jj = self._jj(j)
-        jpow2 = tuple(2.0 ** jj)
+        jpow2 = tuple(self._jpow2(j))
         ## print('-->', jpow2)
         ncoeff = 0
         for qx in qxs:
@@ -272,10 +407,10 @@ class WParams(object):
             zs_min_b, zs_max_b = self.wave.z_range('base', (qx, jpow2, None), self.minx, self.maxx)
             zs_min = np.min((zs_min_d, zs_min_b), axis=0)
             zs_max = np.max((zs_max_d, zs_max_b), axis=0)
-            for zs in itt.product(*all_zs_tensor(zs_min, zs_max)):
-                if (j, qx, zs, jpow2) not in self.coeffs:
-                    self.coeffs[(j, qx, zs, jpow2)] = None
-                    ncoeff += 1
+            new_keys = [(j, qx, zs, jpow2) for zs in map(tuple, all_zs_array(zs_min, zs_max).tolist())
+                        if (j, qx, zs, jpow2) not in self.key_pos]
+            self._append_keys(new_keys, is_alpha_key((j, qx)))
+            ncoeff += len(new_keys)
         return ncoeff
 
     def sqrt_vunit(self):
@@ -287,22 +422,42 @@ class WParams(object):
         ## return gamma(self.k) / gamma(self.k + 0.5) / math.sqrt(n)
         return math.sqrt(n - 1) * gamma(self.k) / gamma(self.k + 0.5) / n
 
+    @staticmethod
+    def nn_tree(xs):
+        "kd-tree for the nearest neighbour queries; an unbalanced, non-compact tree builds faster"
+        return cKDTree(xs, leafsize=32, balanced_tree=False, compact_nodes=False)
+
     def calculate_nearest_balls(self, xs):
         "Calculate and store (k+1)-th nearest balls"
         ix = -2
-        dist, inx = self.ball_tree.query(xs, self.k + 2)
+        if xs.shape[0] < self.k + 2:
+            # cKDTree would pad missing neighbours with inf distances
+            raise ValueError('Expected at least %d samples, got %d' % (self.k + 2, xs.shape[0]))
+        dist, inx = self.ball_tree.query(xs, k=self.k + 2)
         k_near_radious = dist[:, -2:]
-        xs_balls = np.power(k_near_radious, self.wave.dim / 2.0)
-        self.xs_balls = xs_balls[:, 0] * self.sqrt_vunit()
-        self.xs_balls2 = xs_balls[:, 1] * self.sqrt_vunit()
+        xs_balls = half_dim_power(k_near_radious, self.wave.dim) * self.sqrt_vunit()
+        self.xs_balls = xs_balls[:, 0]
+        self.xs_balls2 = xs_balls[:, 1]
         self.xs_balls_inx = inx
+        # key independent values for calc_terms
+        self.xs_balls_sq = self.xs_balls * self.xs_balls
+        self.xs_balls_delta = self.xs_balls2 - self.xs_balls
+        self.xs_near_inx = inx[:, 1:self.k + 1] # position 0 is x_j
 
     def _jj(self, j):
         return np.array([j0 + j for j0 in self.jj0])
 
+    def _jpow2(self, j):
+        "2 ** jj for level j as a read-only array, shared by all keys of the level"
+        if j not in self.jpow2_cache:
+            jpow2 = 2.0 ** self._jj(j)
+            jpow2.setflags(write=False)
+            self.jpow2_cache[j] = jpow2
+        return self.jpow2_cache[j]
+
 
 class WaveletDensityEstimator(object):
-    def __init__(self, waves, k=1, delta_j=0):
+    def __init__(self, waves, k=1, delta_j=0, n_jobs=None, cache_terms=False):
         """
         Builds a shape-preserving estimator based on square root and nearest neighbour distance.
 
@@ -310,11 +465,16 @@ class WaveletDensityEstimator(object):
         :param k: use k-th neighbour
         :param: delta_j: number of levels to go after j0 on the wavelet expansion part; 0 means no wavelet expansion,
             only scaling functions.
+        :param n_jobs: number of threads to calculate coefficients (see joblib.Parallel); None means no threads
+        :param cache_terms: keep the dual and base function values at the sample from calc_coeffs
+            to reuse them in calc_terms; uses memory proportional to #coeffs x n
         """
         self.wave = WaveletTensorProduct([wave_desc[0] for wave_desc in waves])
         self.k = k
         self.jj0 = np.array([wave_desc[1] for wave_desc in waves])
         self.delta_j = delta_j
+        self.n_jobs = n_jobs
+        self.cache_terms = cache_terms
         self.wave_series = None
         self.pdf = None
         self.thresholding = None
@@ -356,12 +516,12 @@ class WaveletDensityEstimator(object):
     def fit(self, xs):
         "Fit estimator to data. xs is a numpy array of dimension n x d, n = samples, d = dimensions"
         print('Regular estimator')
-        t0 = datetime.now()
+        t0 = time.perf_counter()
         self._fitinit(xs)
         self.pdf = self.params.calc_pdf(self.params.coeffs)
         self.name = '%s N=%d j0=%s Dj=%d k=%d #par=%d Full' % (self.wave.name, self.params.n, str(self.jj0),
                                                                self.delta_j, self.k, len(self.params.coeffs))
-        print('secs=', (datetime.now() - t0).total_seconds())
+        print('secs=', time.perf_counter() - t0)
 
     def _iterinit(self, xs):
         if self._xs is xs:
@@ -380,13 +540,13 @@ class WaveletDensityEstimator(object):
 
     def iterfit(self, xs):
         print('Iter estimator: Normed, iterated')
-        t0 = datetime.now()
+        t0 = time.perf_counter()
         self._iterinit(xs)
         coeffs = self.calc_iter_pdf(xs)
         self.pdf = self.params.calc_pdf(coeffs)
         self.name = '%s N=%d j0=%s Dj=%d k=%d #par=%d Iter' % (self.wave.name, self.params.n, str(self.jj0),
                                                                self.delta_j, self.k, len(coeffs))
-        print('secs=', (datetime.now() - t0).total_seconds())
+        print('secs=', time.perf_counter() - t0)
 
 
     def cvfit(self, xs, loss, ordering, is_single=True):
@@ -396,14 +556,14 @@ class WaveletDensityEstimator(object):
         if ordering not in WaveletDensityEstimator.ORDERINGS:
             raise ValueError('Wrong ordering')
         print('CV estimator: %s, %s; single %s' % (loss, ordering, str(is_single)))
-        t0 = datetime.now()
+        t0 = time.perf_counter()
         self._fitinit(xs)
         coeffs = self.calc_pdf_cv(xs, loss, ordering, is_single)
         self.pdf = self.params.calc_pdf(coeffs)
         self.name = '%s N=%d j0=%s Dj=%d k=%d #par=%d Lss=%s Thr=%s M=%s' % (self.wave.name, self.params.n,
                                                                         str(self.jj0), self.delta_j, self.k, len(coeffs),
                                                                         loss[:3], ordering[:4], str(not is_single)[0])
-        print('secs=', (datetime.now() - t0).total_seconds())
+        print('secs=', time.perf_counter() - t0)
 
     Q_ORD = 'QTerm'
     AQ_ORD = 'AQTerm'
@@ -442,7 +602,7 @@ class WaveletDensityEstimator(object):
 
     def best_j(self, xs):
         print("Let's rock Best J")
-        t0 = datetime.now()
+        t0 = time.perf_counter()
         if self.wave.dim != xs.shape[1]:
             raise ValueError("Expected data with %d dimensions, got %d" % (self.wave.dim, xs.shape[1]))
         self.minx = np.amin(xs, axis=0)
@@ -451,7 +611,7 @@ class WaveletDensityEstimator(object):
         # self.params.pre_coeffs but w/ xtest
         # self.params.pre_coeffs(xs_test), kinda
         self.params.n = xs.shape[0]
-        self.params.ball_tree = BallTree(xs)
+        self.params.ball_tree = self.params.nn_tree(xs)
         self.params.calculate_nearest_balls(xs)
         balls = self.params.xs_balls
         omega = self.params.omega(self.params.n)
@@ -481,7 +641,7 @@ class WaveletDensityEstimator(object):
             if ini_j > 8:
                 print('Done')
                 break
-        print('secs=', (datetime.now() - t0).total_seconds())
+        print('secs=', time.perf_counter() - t0)
 
     def calc_iter_pdf(self, xs):
         coeffs = {}
@@ -529,12 +689,12 @@ class WaveletDensityEstimator(object):
                 self.params.calc_indexes_j(lvl_j + dj)
             self.params.calc_coeffs(xs)
             contributions = []
-            for key, tup in self.params.coeffs.items():
+            # coeffs follows the order of params.keys, so is_alpha lines up with it
+            for (key, tup), is_alpha in zip(self.params.coeffs.items(), self.params.is_alpha):
                 coeff, coeff_b, num = tup
                 if coeff == 0.0:
                     continue
                 j, qx, zs, jpow2 = key
-                is_alpha = j == 0 and all([qi == 0 for qi in qx])
                 if is_alpha or j < lvl_j:
                     continue
                 # TODO - add only of level before has X% coefficients
@@ -603,32 +763,30 @@ class WaveletDensityEstimator(object):
         if ordering == WaveletDensityEstimator.RT_ORD:
             return self.calc_pdf_ref_tao(xs, loss)
         coeffs = {}
-        alpha_contributions = []
         contributions = []
-        alpha_contribution = 0.0
-        alpha_norm = 0.0
         fun = WaveletDensityEstimator.ORDERINGS[ordering]
-        for key, tup in self.params.coeffs.items():
+        params = self.params
+        # calculated rows only, straight from the coefficient arrays
+        rows = np.flatnonzero(params.done & (params.coeff != 0.0))
+        keys = [params.keys[row] for row in rows]
+        term1s, term2s, term3s, coeffs2 = params.calc_terms_all(keys, params.coeff[rows], params.coeff_b[rows], xs)
+        coeff_contributions = term1s - term2s + term3s
+        is_alpha = params.is_alpha[rows]
+        alpha_norm = coeffs2[is_alpha].sum()
+        alpha_contribution = coeff_contributions[is_alpha].sum()
+        # TODO: alpha could be filtered for Q > 0 (!!)
+        tups = list(zip(params.coeff[rows], params.coeff_b[rows], params.num[rows]))
+        for pos in np.flatnonzero(is_alpha):
+            coeffs[keys[pos]] = tups[pos]
+        for pos in np.flatnonzero(~is_alpha):
+            key = keys[pos]
+            tup = tups[pos]
             coeff, coeff_b, num = tup
-            if coeff == 0.0:
-                continue
-            j, qx, zs, jpow2 = key
-            is_alpha = j == 0 and all([qi == 0 for qi in qx])
-            term1, term2, term3, coeff2 = self.params.calc_terms(key, coeff, coeff_b, xs)
-            coeff_contribution = term1 - term2 + term3
-            if is_alpha:
-                if True: #coeff_contribution > 0:
-                    coeffs[key] = tup
-                    alpha_norm += coeff2
-                    alpha_contribution += coeff_contribution
-                    # TODO: alpha could be filtered for Q > 0 (!!)
-                    # threshold = fun(coeff, coeff2, coeff_contribution, j)
-                    # alpha_contributions.append(((key, tup), threshold, (term1, term2, term3, coeff2)))
-                continue
-
+            j = key[0]
+            coeff_contribution, coeff2 = coeff_contributions[pos], coeffs2[pos]
             # threshold is the order-by number; here the options
             threshold = fun(coeff, coeff2, coeff_contribution, j)
-            contributions.append(((key, tup), threshold, (term1, term2, term3, coeff2)))
+            contributions.append(((key, tup), threshold, (term1s[pos], term2s[pos], term3s[pos], coeff2)))
 
         print('alphas =', len(coeffs))
 
@@ -730,7 +888,7 @@ class WaveletDensityEstimator(object):
         state_wde = WaveletDensityEstimator.StateWDE(loss, alpha_norm, alpha_contribution)
         for j in range(self.delta_j):
             contrib_j = list(filter(lambda tup: tup[0][0][0] == j, sorted_contributions))
-            contrib_j = sorted(contrib_j, key=lambda values: -values[1])
+            contrib_j = [contrib_j[pos] for pos in np.argsort(-contrib_thresholds(contrib_j), kind='mergesort')]
             if j < th_j:
                 threshold_c = float('-inf')
             elif j == th_j:
@@ -800,42 +958,42 @@ class WaveletDensityEstimator(object):
 
     def calc_c_function(self, contributions, curr_norm, curr_contribution, loss, alpha_nump):
         ## contributions = sorted(contributions, key=lambda values: -values[1]) ## <-- original
-        contributions = sorted(contributions, key=lambda values: (values[0][0][0], -values[1])) ## j first
+        ## j first, then by decreasing threshold; lexsort is stable as `sorted` was
+        order = np.lexsort((-contrib_thresholds(contributions), [values[0][0][0] for values in contributions]))
+        contributions = [contributions[pos] for pos in order]
         print('curr_norm, curr_contribution =', curr_norm, curr_contribution)
 
-        batta_sum = curr_contribution
-        norm_sum = curr_norm
-        vals = []
-        for nump, values in enumerate(contributions):
-            j = values[0][0][0]
-            threshold = values[1]
-            term1, term2, term3, coeff2 = values[2]
-            norm_sum += coeff2
-            coeff_contribution = term1 - term2 + term3
-            batta_sum += coeff_contribution
-            if loss == WaveletDensityEstimator.ORIGINAL_LOSS:
-                target = 1 - batta_sum
-            elif loss == WaveletDensityEstimator.NORMED_LOSS:
-                target = 1 - batta_sum / math.sqrt(norm_sum)
-            elif loss == WaveletDensityEstimator.NEW_LOSS:
-                target = 0.5 + 0.5 * norm_sum - batta_sum
-            else:
-                raise ValueError('Unknown loss=%s' % loss)
+        if len(contributions) == 0:
+            return np.array([]), contributions
+        terms = np.array([values[2] for values in contributions], dtype=float)
+        term1, term2, term3, coeff2 = terms.T
+        # running sums over the sorted contributions as prefix sums
+        norm_sum = curr_norm + np.cumsum(coeff2)
+        batta_sum = curr_contribution + np.cumsum(term1 - term2 + term3)
+        if loss == WaveletDensityEstimator.ORIGINAL_LOSS:
+            target = 1 - batta_sum
+        elif loss == WaveletDensityEstimator.NORMED_LOSS:
+            target = 1 - batta_sum / np.sqrt(norm_sum)
+        elif loss == WaveletDensityEstimator.NEW_LOSS:
+            target = 0.5 + 0.5 * norm_sum - batta_sum
+        else:
+            raise ValueError('Unknown loss=%s' % loss)
 
-            # MDL correction (?) - how do u justify this?
-            ## BELOW - not justified, completly "heuristic" - one could try to see if related to
-            ## 2017, Peter, Rangarajan, Moyou - The Geometry of Orthogonal-Series, Square-Root Density Estimators,
-            ##       Applications in Computer Vision and Model Selection.pdf
+        # MDL correction (?) - how do u justify this?
+        ## BELOW - not justified, completly "heuristic" - one could try to see if related to
+        ## 2017, Peter, Rangarajan, Moyou - The Geometry of Orthogonal-Series, Square-Root Density Estimators,
+        ##       Applications in Computer Vision and Model Selection.pdf
 
-            # pp = alpha_nump + nump
-            # target += math.log(math.log(pp) + pp / 2 * math.log(math.pi)
-            #                    - pp / 2 * (math.log(2 * math.pi) - math.log(self.params.n))) / math.log(self.params.n)
+        # pp = alpha_nump + np.arange(len(contributions))
+        # target += np.log(np.log(pp) + pp / 2 * math.log(math.pi)
+        #                  - pp / 2 * (math.log(2 * math.pi) - math.log(self.params.n))) / math.log(self.params.n)
 
-            ## Another alternative is to penalise based on J (we have math.sqrt(j) in a threshold calculation
-            ## but, again, what would be the justification for that ... variance considerations? where?
+        ## Another alternative is to penalise based on J (we have math.sqrt(j) in a threshold calculation
+        ## but, again, what would be the justification for that ... variance considerations? where?
 
-            vals.append((threshold, target, j))
-        return np.array(vals), contributions
+        js = np.array([values[0][0][0] for values in contributions], dtype=float)
+        vals = np.stack([contrib_thresholds(contributions), target, js], axis=1)
+        return vals, contributions
 
     class StateTaoJ:
         pass
@@ -851,12 +1009,12 @@ class WaveletDensityEstimator(object):
         alpha_contribution = 0.0
         alpha_norm = 0.0
         fun = WaveletDensityEstimator.ORDERINGS[ordering]
-        for key, tup in self.params.coeffs.items():
+        # coeffs follows the order of params.keys, so is_alpha lines up with it
+        for (key, tup), is_alpha in zip(self.params.coeffs.items(), self.params.is_alpha):
             coeff, coeff_b, num = tup
             if coeff == 0.0:
                 continue
             j, qx, zs, jpow2 = key
-            is_alpha = j == 0 and all([qi == 0 for qi in qx])
             term1, term2, term3, coeff2 = self.params.calc_terms(key, coeff, coeff_b, xs)
             coeff_contribution = term1 - term2 + term3
             if is_alpha:
@@ -900,13 +1058,13 @@ class WaveletDensityEstimator(object):
 
     def mdlfit(self, xs):
         print('MDL-like estimator')
-        t0 = datetime.now()
+        t0 = time.perf_counter()
         self._fitinit(xs, cv=True)
         coeffs = self.calc_pdf_mdl(xs)
         self.pdf = self.params.calc_pdf(coeffs)
         self.name = '%s, n=%d, j0=%s, Dj=%d CV-like #params=%d' % (self.wave.name, self.params.n, str(self.jj0),
                                                               self.delta_j, len(coeffs))
-        print('secs=', (datetime.now() - t0).total_seconds())
+        print('secs=', time.perf_counter() - t0)
 
     def calc_pdf_mdl(self, xs):
         all_coeffs = []
@@ -934,11 +1092,21 @@ class WaveletDensityEstimator(object):
         return {key:self.params.coeffs[key] for key in keys}
 
 
+def contrib_thresholds(contributions):
+    "Thresholds of a list of ((key, tup), threshold, terms) contributions as a float array"
+    return np.array([values[1] for values in contributions], dtype=float)
+
+
+def is_alpha_key(key):
+    "True for (j, qx, ...) keys of alpha coefficients, i.e. j == 0 and all qx == 0"
+    return key[0] == 0 and not any(key[1])
+
+
 def coeff_sort(key_tup):
     key, tup = key_tup
     j, qx, zs, jpow2 = key
     coeff, num = tup
-    is_alpha = j == 0 and all([qi == 0 for qi in qx])
+    is_alpha = is_alpha_key(key)
     v_th = math.fabs(coeff) / math.sqrt(j + 1)
     return (not is_alpha, -v_th, key)
 
@@ -946,11 +1114,11 @@ def coeff_sort_no_j(key_tup):
     key, tup = key_tup
     j, qx, zs, jpow2 = key
     coeff, num = tup
-    is_alpha = j == 0 and all([qi == 0 for qi in qx])
+    is_alpha = is_alpha_key(key)
     v_th = math.fabs(coeff)
     return (not is_alpha, -v_th, key)
 
 def _cv2_key_sort(key):
     j, qx, zs, jpow2 = key
-    is_alpha = j == 0 and all([qi == 0 for qi in qx])
+    is_alpha = is_alpha_key(key)
     return (not is_alpha, -j, qx, zs)
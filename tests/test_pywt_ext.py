@@ -42,6 +42,19 @@ def test_fun_support_range(wave, what, ix, support):
     assert_array_almost_equal(support[1], b)
 
 
+@pytest.mark.parametrize("wave", [
+WaveletTensorProduct(('db4', 'db2')), WaveletTensorProduct(('bior2.4', 'bior2.4'))
+])
+@pytest.mark.parametrize('what', ['base', 'dual'])
+@pytest.mark.parametrize('ix', [((0, 0), (1, 2), (0, 1)), ((1, 0), (2, 4), (-1, 2))])
+def test_fun_supp_ix(wave, what, ix):
+    "Test fun_supp_ix gives the same as fun_ix and supp_ix"
+    xs = np.random.RandomState(1).uniform(-1, 2, (50, 2))
+    vals, supp = wave.fun_supp_ix(what, ix)(xs)
+    assert_array_almost_equal(wave.fun_ix(what, ix)(xs), vals)
+    assert (wave.supp_ix(what, ix)(xs) == supp).all()
+
+
 @pytest.mark.parametrize("wave", [
 Wavelet('db1'), Wavelet('db2'), Wavelet('db4'),
 Wavelet('db6'), Wavelet('bior1.3')
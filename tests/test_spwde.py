@@ -1,8 +1,10 @@
 import math
 import numpy as np
+import pytest
 
-from numpy.testing import assert_array_almost_equal
-from pywde.spwde import SPWDE, calc_sqrt_vs, sqrt_vunit
+from numpy.testing import assert_array_almost_equal, assert_allclose
+from pywde.common import all_zs_array
+from pywde.spwde import SPWDE, ZsValues, calc_sqrt_vs, sqrt_vunit, balls_no_i, sums_no_i
 
 
 def test_calc_alphas_no_i():
@@ -18,10 +20,10 @@ def test_calc_alphas_no_i():
     balls_info = calc_sqrt_vs(data, k)
     spwde.minx = np.amin(data, axis=0)
     spwde.maxx = np.amax(data, axis=0)
-    spwde.calc_funs_at(j0, data)
-    alphas = spwde.calc_alphas_no_i(j0, data, 1, balls_info)
-    for k, (v1, v2) in alphas.items():
-        if k == (0, 0):
+    _, base_fun_xs, dual_fun_xs = spwde.calc_funs_at(j0, (0, 0), data)
+    zs_list, alphas, alphas_d = spwde.calc_coeffs_no_i(base_fun_xs, dual_fun_xs, data, balls_info)
+    for zs, v1, v2 in zip(zs_list, alphas[:, 1], alphas_d[:, 1]):
+        if zs == (0, 0):
             assert math.fabs(v2 - 0.447213595499959) < 0.000001
             assert math.fabs(v1 - 0.447213595499959) < 0.000001
         else:
@@ -50,3 +52,86 @@ def test_calc_sqrt_vs():
     vv = np.array([2.23606797749979, 1.414213562373095, 2.23606797749979]) * sqrt_vunit(2)
     assert_array_almost_equal(ball_info.sqrt_vol_k_plus_1, vv)
 
+
+def test_sums_no_i():
+    data = np.array([
+        [0, 0],
+        [1, 1],
+        [2, 1],
+        [0, 2],
+    ])
+    ball_info = calc_sqrt_vs(data, 1)
+    values = np.array([
+        [1., 2., 3., 4.],
+        [0.5, -1., 0., 2.],
+    ])
+    sums = sums_no_i(values, ball_info)
+    for i in range(data.shape[0]):
+        balls = balls_no_i(ball_info, i)
+        exp = (values * balls).sum(axis=1) - values[:, i] * balls[i]
+        assert_array_almost_equal(sums[:, i], exp)
+
+
+def test_calc_1_coeff_no_i_all():
+    k = 1
+    data = np.array([
+        [0.1, 0.2],
+        [0.4, 0.3],
+        [0.7, 0.6],
+        [0.2, 0.9],
+        [0.8, 0.1],
+    ])
+    spwde = SPWDE((('bior2.4', 1), ('bior2.4', 1)), k=k)
+    balls_info = calc_sqrt_vs(data, k)
+    spwde.minx = np.amin(data, axis=0)
+    spwde.maxx = np.amax(data, axis=0)
+    _, base_fun_xs, dual_fun_xs = spwde.calc_funs_at(0, (1, 1), data)
+    for zs in dual_fun_xs:
+        coeff, coeff_d = spwde.calc_1_coeff_no_i_all(base_fun_xs, dual_fun_xs, data, balls_info, zs)
+        for i in range(data.shape[0]):
+            exp, exp_d = spwde.calc_1_coeff_no_i(base_fun_xs, dual_fun_xs, 0, data, i,
+                                                 balls_no_i(balls_info, i), (1, 1), zs)
+            assert math.fabs(coeff[i] - exp) < 0.000001
+            assert math.fabs(coeff_d[i] - exp_d) < 0.000001
+
+
+def test_zs_values_intersect():
+    base = all_zs_array((-2, 0), (1, 3))
+    dual = all_zs_array((-1, -1), (2, 2))
+    base_xs = ZsValues(base, np.zeros((base.shape[0], 1)))
+    dual_xs = ZsValues(dual, np.zeros((dual.shape[0], 1)))
+    base_rows, dual_rows = base_xs.intersect(dual_xs)
+    exp = [zs for zs in base_xs.zs_list if zs in dual_xs]
+    assert [base_xs.zs_list[row] for row in base_rows] == exp
+    assert [dual_xs.zs_list[row] for row in dual_rows] == exp
+    # rows out of zs order still come back in lexicographic zs order
+    dual_xs = ZsValues(dual[::-1], np.zeros((dual.shape[0], 1)))
+    base_rows, dual_rows = base_xs.intersect(dual_xs)
+    assert [base_xs.zs_list[row] for row in base_rows] == exp
+    assert [dual_xs.zs_list[row] for row in dual_rows] == exp
+
+
+# B hat per level on the sample in `test_best_j`, as given by the original per-sample loop;
+# wave values are now interpolated linearly rather than with cubic splines, hence rtol
+BEST_J_BASELINE = {
+    SPWDE.TARGET_NORMED: [0.49774619631353484, 0.9592996379161696, 0.9371798313463048, 0.7125135533615842,
+                          0.48725700840261127, 0.28452784540472403, 0.08452896834867966, 0.008568604459332331],
+    SPWDE.TARGET_DIFF: [0.21636977620497594, 0.8849165186153595, 0.8348569160998496, 0.033613926946399086,
+                        -1.9695254766972057, -13.194497314579248, -75.4027019995947, -268.4815623871018],
+}
+
+
+@pytest.mark.parametrize("mode", [SPWDE.TARGET_NORMED, SPWDE.TARGET_DIFF])
+@pytest.mark.parametrize("n_jobs,dtype", [(None, np.float64), (4, np.float64), (None, np.float32)])
+def test_best_j(mode, n_jobs, dtype):
+    data = np.random.RandomState(0).beta(2, 3, size=(60, 2))
+    spwde = SPWDE((('bior2.4', 0), ('bior2.4', 0)), k=1, dtype=dtype)
+    spwde.best_j(data, mode, n_jobs=n_jobs, early_stop=False)
+    assert [info_j[0] for info_j in spwde.best_j_data] == list(range(8))
+    assert_allclose([info_j[2] for info_j in spwde.best_j_data], BEST_J_BASELINE[mode], rtol=1e-4, atol=1e-5)
+    best_j = [info_j[0] for info_j in spwde.best_j_data if info_j[1]]
+    assert best_j == [1]
+    # stopping early picks the same level
+    spwde.best_j(data, mode, n_jobs=n_jobs)
+    assert [info_j[0] for info_j in spwde.best_j_data if info_j[1]] == best_j
+    assert spwde.best_j(data, mode, stop_on_max=True) == 1 and spwde.the_best_j == 1
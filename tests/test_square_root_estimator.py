@@ -2,8 +2,8 @@ import math
 import pytest
 import mock
 import numpy as np
-from numpy.testing import assert_array_almost_equal
-from pywde.square_root_estimator import WParams, WaveletDensityEstimator, WaveletTensorProduct
+from numpy.testing import assert_array_almost_equal, assert_allclose
+from pywde.square_root_estimator import WParams, WaveletDensityEstimator, WaveletTensorProduct, smooth
 from .conftest import intersect_2d, assert_almost_equal
 
 
@@ -14,6 +14,8 @@ def mock_wde_1():
     obj.wave = WaveletTensorProduct(('db2', 'bior2.4'))
     obj.jj0 = np.array([0, 1])
     obj.delta_j = 2
+    obj.n_jobs = None
+    obj.cache_terms = False
     return obj
 
 @pytest.fixture
@@ -76,6 +78,162 @@ def test_betas(mock_wde_1_with_data):
     assert num == 3                            # TODO check
 
 
+def _calc_terms_loop(wparams, key, coeff, coeff_b, xs):
+    "Q terms for one key with the original per-sample loop"
+    j, qx, zs, jpow2 = key
+    fun_i_dual = wparams.wave.fun_ix('dual', (qx, np.array(jpow2), zs))(xs)
+    fun_i_base = wparams.wave.fun_ix('base', (qx, np.array(jpow2), zs))(xs)
+    omega_n = wparams.omega(wparams.n)
+    omega_n1 = wparams.omega(wparams.n - 1)
+    omega_n2 = omega_n * omega_n1
+    term1 = omega_n1 / omega_n * coeff * coeff_b
+    term2 = omega_n2 * (fun_i_dual * fun_i_base * wparams.xs_balls * wparams.xs_balls).sum()
+    vals_i = np.zeros(wparams.n)
+    for j in range(wparams.n):
+        deltaV_j = wparams.xs_balls2[j] - wparams.xs_balls[j]
+        for k in range(wparams.k):
+            i = wparams.xs_balls_inx[j, k + 1]
+            vals_i[i] += fun_i_base[i] * fun_i_dual[j] * wparams.xs_balls[i] * deltaV_j
+    term3 = omega_n2 * vals_i.sum()
+    return term1, term2, term3, coeff * coeff_b
+
+
+@pytest.mark.parametrize("k", [1, 3])
+def test_calc_terms_all(mock_wde_1, k):
+    mock_wde_1.k = k
+    data = np.random.RandomState(k).uniform(0.2, 0.6, size=(12, 2))
+    mock_wde_1.minx = np.amin(data, axis=0)
+    mock_wde_1.maxx = np.amax(data, axis=0)
+    wparams = WParams(mock_wde_1)
+    wparams.pre_coeffs(data)
+    wparams.calc_coeffs(data)
+    assert wparams.xs_near_inx.shape == (data.shape[0], k)
+    items = [(key, tup) for key, tup in wparams.coeffs.items() if tup[0] != 0.0][::7]
+    keys = [key for key, _ in items]
+    coeffs = np.array([tup[0] for _, tup in items])
+    coeffs_b = np.array([tup[1] for _, tup in items])
+    terms = wparams.calc_terms_all(keys, coeffs, coeffs_b, data)
+    for row, key in enumerate(keys):
+        expected = _calc_terms_loop(wparams, key, coeffs[row], coeffs_b[row], data)
+        assert_allclose(expected, [term[row] for term in terms], rtol=1e-10, atol=1e-14)
+
+
+def test_calc_terms_all_blocks(mock_wde_1_with_data):
+    wde, data = mock_wde_1_with_data
+    wparams = WParams(wde)
+    wparams.pre_coeffs(data)
+    wparams.calc_coeffs(data)
+    keys = wparams.keys
+    expected = wparams.calc_terms_all(keys, wparams.coeff, wparams.coeff_b, data)
+    wparams.TERMS_BLOCK = 5
+    assert len(keys) % 5 != 0
+    assert_array_almost_equal(expected, wparams.calc_terms_all(keys, wparams.coeff, wparams.coeff_b, data), 14)
+
+
+def test_calc_terms_cached(mock_wde_1_with_data):
+    wde, data = mock_wde_1_with_data
+    wparams = WParams(wde)
+    wparams.pre_coeffs(data)
+    wparams.calc_coeffs(data)
+    wde.cache_terms = True
+    cached = WParams(wde)
+    cached.pre_coeffs(data)
+    cached.calc_coeffs(data)
+    assert set(cached.terms_cache.keys()) == set(cached.coeffs.keys())
+    for key, (coeff, coeff_b, num) in wparams.coeffs.items():
+        expected = wparams.calc_terms(key, coeff, coeff_b, data)
+        assert_array_almost_equal(expected, cached.calc_terms(key, coeff, coeff_b, data), 12)
+
+
+def test_coeffs_arrays(mock_wde_1_with_data):
+    wde, data = mock_wde_1_with_data
+    wparams = WParams(wde)
+    assert all(tup is None for tup in wparams.coeffs.values())
+    wparams.pre_coeffs(data)
+    wparams.calc_coeffs(data)
+    assert list(wparams.coeffs.keys()) == wparams.keys
+    for pos, (key, (coeff, coeff_b, num)) in enumerate(wparams.coeffs.items()):
+        assert wparams.key_pos[key] == pos
+        assert (coeff, coeff_b, num) == (wparams.coeff[pos], wparams.coeff_b[pos], wparams.num[pos])
+        assert wparams.is_alpha[pos] == (key[0] == 0 and key[1] == (0, 0))
+    assert wparams.is_alpha.any() and not wparams.is_alpha.all()
+    coeffs = dict(wparams.coeffs)
+    with pytest.raises(TypeError):
+        wparams.coeffs[wparams.keys[0]] = (0.0, 0.0, 0)
+    wparams.coeffs = {}
+    assert len(wparams.keys) == 0 and wparams.coeffs == {}
+    wparams.coeffs = coeffs
+    assert wparams.coeffs == coeffs and wparams.done.all()
+    assert list(wparams.is_alpha) == [key[0] == 0 and key[1] == (0, 0) for key in wparams.keys]
+
+
+@pytest.mark.parametrize("n", [5, 6, 11, 100])
+def test_smooth_hanning5(n):
+    x = np.random.RandomState(n).rand(n)
+    s = np.r_[x[4:0:-1], x, x[-2:-6:-1]]
+    w = np.hanning(5)
+    expected = np.convolve(w / w.sum(), s, mode='valid')
+    assert_array_almost_equal(expected, smooth(x, 5, 'hanning'), 12)
+
+
+def test_gen_pdf(mock_wde_1_with_data):
+    wde, data = mock_wde_1_with_data
+    wparams = WParams(wde)
+    wparams.pre_coeffs(data)
+    wparams.calc_coeffs(data)
+    items = [(key, tup) for key, tup in wparams.coeffs.items() if tup[0] * tup[1] != 0.0]
+    grid = np.meshgrid(np.linspace(0.2, 0.4, 4), np.linspace(0.2, 0.6, 5))
+    for coords in [data, tuple(grid)]:
+        xs_sum = np.zeros(grid[0].shape if type(coords) == tuple else data.shape[0])
+        # one key at a time, as a plain incremental loop
+        exp_sum, norm_const = xs_sum.copy(), 0.0
+        expected = []
+        for key, (coeff, coeff_b, num) in items:
+            j, qx, zs, jpow2 = key
+            exp_sum = exp_sum + coeff * wparams.wave.fun_ix('base', (qx, np.array(jpow2), zs))(coords)
+            norm_const += coeff * coeff_b
+            expected.append((key, exp_sum * exp_sum / norm_const))
+        got = list(wparams.gen_pdf(xs_sum, items, coords))
+        assert [key for key, _ in got] == [key for key, _ in expected]
+        for (_, vals), (_, exp_vals) in zip(got, expected):
+            assert_array_almost_equal(exp_vals, vals, 12)
+        assert (xs_sum == 0).all()
+
+
+@pytest.mark.parametrize("loss", [
+    WaveletDensityEstimator.ORIGINAL_LOSS,
+    WaveletDensityEstimator.NORMED_LOSS,
+    WaveletDensityEstimator.NEW_LOSS,
+])
+def test_calc_c_function(loss):
+    wde = WaveletDensityEstimator((('db2', 0), ('db2', 0)), delta_j=2)
+    rnd = np.random.RandomState(1)
+    contributions = []
+    for pos in range(12):
+        j = pos % 2
+        key = (j, (1, 0), (pos, 0), (2.0 ** j, 2.0 ** j))
+        # repeated thresholds to check ties keep their order
+        threshold = float(rnd.randint(4))
+        terms = tuple(rnd.rand(4))
+        contributions.append(((key, (0.1, 0.1, 3)), threshold, terms))
+    curr_norm, curr_contribution = 0.8, 0.3
+    vals, sorted_contributions = wde.calc_c_function(contributions, curr_norm, curr_contribution, loss, 3)
+    expected_contributions = sorted(contributions, key=lambda values: (values[0][0][0], -values[1]))
+    assert sorted_contributions == expected_contributions
+    norm_sum, batta_sum = curr_norm, curr_contribution
+    for row, values in enumerate(expected_contributions):
+        term1, term2, term3, coeff2 = values[2]
+        norm_sum += coeff2
+        batta_sum += term1 - term2 + term3
+        if loss == WaveletDensityEstimator.ORIGINAL_LOSS:
+            target = 1 - batta_sum
+        elif loss == WaveletDensityEstimator.NORMED_LOSS:
+            target = 1 - batta_sum / math.sqrt(norm_sum)
+        else:
+            target = 0.5 + 0.5 * norm_sum - batta_sum
+        assert_array_almost_equal((values[1], target, values[0][0][0]), vals[row], 12)
+
+
 def _test_wparam_calc_coeffs_no_cv(mock_wde_with_data):
     wde, data = mock_wde_with_data
     wparams = WParams(wde)